@@ -0,0 +1,81 @@
+"""Benchmark the startup time of the wheelhouse_uploader command line
+
+Each scenario is run in a fresh Python interpreter several times and the best
+wall clock time is reported. The script fails if the command line module pulls
+a slow import (libcloud or pkg_resources) before it is actually needed or if
+a scenario is slower than the allowed budget:
+
+    python benchmarks/bench_import_time.py --budget 0.5
+
+"""
+import argparse
+import os
+import subprocess
+import sys
+from timeit import default_timer as time
+
+SLOW_MODULES = ['libcloud', 'pkg_resources']
+
+SCENARIOS = [
+    ('baseline: python -c pass', ['-c', 'pass']),
+    ('import commandline',
+     ['-c', 'import wheelhouse_uploader.commandline']),
+    ('import fetch', ['-c', 'import wheelhouse_uploader.fetch']),
+    ('upload with missing secret',
+     ['-m', 'wheelhouse_uploader', 'upload', '--username', 'bench',
+      'container']),
+]
+
+CHECK_SLOW_IMPORTS = """
+import sys
+import wheelhouse_uploader.commandline
+import wheelhouse_uploader.fetch
+slow = [name for name in {slow!r}
+        if any(m == name or m.startswith(name + '.') for m in sys.modules)]
+if slow:
+    sys.exit('Slow modules imported at startup: %s' % ', '.join(slow))
+"""
+
+
+def _run(args, env):
+    tic = time()
+    subprocess.check_call([sys.executable] + args, env=env,
+                          stdout=subprocess.PIPE)
+    return time() - tic
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.split('\n')[0])
+    parser.add_argument('--repeat', type=int, default=5)
+    parser.add_argument('--budget', type=float, default=None,
+                        help='maximum allowed startup time overhead in '
+                             'seconds compared to the baseline')
+    options = parser.parse_args()
+
+    env = dict(os.environ)
+    env.pop('WHEELHOUSE_UPLOADER_SECRET', None)
+    subprocess.check_call(
+        [sys.executable, '-c', CHECK_SLOW_IMPORTS.format(slow=SLOW_MODULES)],
+        env=env)
+
+    baseline = None
+    over_budget = []
+    for name, args in SCENARIOS:
+        best = min(_run(args, env) for _ in range(options.repeat))
+        if baseline is None:
+            baseline = best
+            print('%-30s %7.1f ms' % (name, best * 1e3))
+            continue
+        overhead = best - baseline
+        print('%-30s %7.1f ms (+%.1f ms)'
+              % (name, best * 1e3, overhead * 1e3))
+        if options.budget is not None and overhead > options.budget:
+            over_budget.append(name)
+
+    if over_budget:
+        sys.exit('Startup time budget of %0.3fs exceeded for: %s'
+                 % (options.budget, ', '.join(over_budget)))
+
+
+if __name__ == '__main__':
+    main()
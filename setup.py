@@ -25,14 +25,13 @@ setup(
     ],
     setup_requires=['setuptools-markdown'],
     install_requires=[
-        "setuptools>=0.9",  # required for PEP 440 version parsing
-        "packaging",
+        "packaging",  # required for PEP 440 version parsing
         "certifi",
-        'futures; python_version == "2.7"',
         # https://github.com/ogrisel/wheelhouse-uploader/issues/29
         "apache-libcloud==2.2.1",
     ],
     long_description_markdown_filename='README.md',
+    python_requires='>=3.5',
     classifiers=[
         'License :: OSI Approved',
         'Programming Language :: Python',
@@ -41,8 +40,6 @@ setup(
         'Operating System :: POSIX',
         'Operating System :: Unix',
         'Operating System :: MacOS',
-        'Programming Language :: Python :: 2',
-        'Programming Language :: Python :: 2.7',
         'Programming Language :: Python :: 3',
         'Programming Language :: Python :: 3.5',
         'Programming Language :: Python :: 3.6',
@@ -0,0 +1,222 @@
+"""Content-addressed cache for downloaded artifacts
+
+Build hosts often fetch the same artifacts for several projects or release
+checkouts. The cache stores each downloaded file once, under a key derived
+from its sha256 digest when the index provides it (or from its URL and size
+otherwise), and hardlinks it into the destination folders of the subsequent
+fetches. Files are copied instead when hardlinks are not supported (e.g. the
+cache and the destination folder are on different file systems).
+
+Downloaded files are copied into the cache and the cache entries are made
+read-only, so that modifying a fetched file does not corrupt the cache.
+
+The least recently used entries are evicted when the total size of the cache
+exceeds its limit. The time of last use of each entry is recorded as the
+modification time of an empty sidecar file rather than of the entry itself:
+the entries share their metadata with the fetched files they are linked to.
+
+"""
+import os
+import shutil
+import stat
+import threading
+from hashlib import sha256
+
+DEFAULT_MAX_SIZE = int(5e9)
+
+CACHE_DIR_ENV = 'WHEELHOUSE_UPLOADER_CACHE_DIR'
+
+# Suffix of the sidecar files recording the last use of the entries
+ACCESS_SUFFIX = '.used'
+
+
+def default_cache_dir():
+    """Default location of the cache folder
+
+    Can be overridden with the WHEELHOUSE_UPLOADER_CACHE_DIR environment
+    variable.
+
+    """
+    if os.environ.get(CACHE_DIR_ENV):
+        return os.environ[CACHE_DIR_ENV]
+    cache_home = os.environ.get('XDG_CACHE_HOME',
+                                os.path.join('~', '.cache'))
+    return os.path.join(os.path.expanduser(cache_home), 'wheelhouse-uploader')
+
+
+def file_sha256(filepath, buffer_size=int(1e6)):
+    digest = sha256()
+    with open(filepath, 'rb') as f:
+        data = f.read(buffer_size)
+        while data:
+            digest.update(data)
+            data = f.read(buffer_size)
+    return digest.hexdigest()
+
+
+def _sha256_text(text):
+    return sha256(text.encode('utf-8')).hexdigest()
+
+
+def _link_or_copy(src, dst):
+    tmp_dst = dst + '.part'
+    if os.path.exists(tmp_dst):
+        os.unlink(tmp_dst)
+    try:
+        os.link(src, tmp_dst)
+    except OSError:
+        # Hard links are not supported by the file system
+        shutil.copyfile(src, tmp_dst)
+    if os.path.exists(dst):
+        os.unlink(dst)
+    shutil.move(tmp_dst, dst)
+
+
+def _touch(path):
+    with open(path, 'ab'):
+        pass
+    os.utime(path, None)
+
+
+def _unlink(path):
+    # Read-only files cannot be deleted under Windows
+    os.chmod(path, stat.S_IREAD | stat.S_IWRITE)
+    os.unlink(path)
+
+
+class DownloadCache(object):
+    """Shared cache of downloaded artifacts with a LRU size limit
+
+    >>> import tempfile
+    >>> cache = DownloadCache(tempfile.mkdtemp())
+    >>> cache.key('http://example.org/a.whl', sha256='cafe')
+    'sha256-cafe'
+    >>> cache.key('http://example.org/a.whl#md5=f00', size=12)
+    ...                                                   # doctest: +ELLIPSIS
+    'url-...'
+
+    Cached entries are copies: editing the stored file or a fetched file
+    in place does not change the content of the cache, and fetching an
+    entry leaves the modification time of the linked files unchanged:
+
+    >>> import os, time
+    >>> folder = tempfile.mkdtemp()
+    >>> filepath = os.path.join(folder, 'a.whl')
+    >>> with open(filepath, 'wb') as f:
+    ...     _ = f.write(b'content')
+    >>> cache.store('sha256-cafe', filepath)
+    >>> with open(filepath, 'wb') as f:
+    ...     _ = f.write(b'modified')
+    >>> fetched = os.path.join(folder, 'b.whl')
+    >>> cache.fetch('sha256-cafe', fetched)
+    True
+    >>> with open(fetched, 'rb') as f:
+    ...     f.read()
+    b'content'
+    >>> mtime = os.stat(fetched).st_mtime
+    >>> time.sleep(0.01)
+    >>> cache.fetch('sha256-cafe', os.path.join(folder, 'c.whl'))
+    True
+    >>> os.stat(fetched).st_mtime == mtime
+    True
+    >>> cache.fetch('sha256-f00', os.path.join(folder, 'd.whl'))
+    False
+
+    """
+
+    def __init__(self, folder=None, max_size=DEFAULT_MAX_SIZE):
+        if folder is None:
+            folder = default_cache_dir()
+        self.folder = folder
+        self.max_size = max_size
+        self._lock = threading.Lock()
+        if not os.path.exists(folder):
+            os.makedirs(folder)
+
+    def key(self, url, sha256=None, size=None):
+        if sha256 is not None:
+            return 'sha256-' + sha256.lower()
+        url = url.split('#', 1)[0]
+        url_key = '%s\n%s' % (url, size)
+        return 'url-' + _sha256_text(url_key)
+
+    def _path(self, key):
+        return os.path.join(self.folder, key)
+
+    def fetch(self, key, filepath):
+        """Link or copy the cached entry to filepath if it exists
+
+        Return True on cache hit.
+
+        """
+        path = self._path(key)
+        if not os.path.exists(path):
+            return False
+        try:
+            _link_or_copy(path, filepath)
+        except (IOError, OSError):
+            # The entry was evicted in the mean time
+            return False
+        try:
+            # Mark the entry as recently used
+            _touch(path + ACCESS_SUFFIX)
+        except (IOError, OSError):
+            pass
+        return True
+
+    def store(self, key, filepath):
+        """Add a downloaded file to the cache and evict old entries"""
+        path = self._path(key)
+        tmp_path = '%s.%d.%d.tmp' % (path, os.getpid(),
+                                     threading.current_thread().ident)
+        try:
+            # Copy rather than link: the downloaded file is owned by the
+            # caller who might modify it
+            shutil.copyfile(filepath, tmp_path)
+            os.chmod(tmp_path, stat.S_IREAD | stat.S_IRGRP | stat.S_IROTH)
+            if os.path.exists(path):
+                _unlink(path)
+            os.rename(tmp_path, path)
+            _touch(path + ACCESS_SUFFIX)
+        except (IOError, OSError) as e:
+            # The cache is an optimization: never fail the fetch because of it
+            print('WARNING: failed to cache %s: %s' % (filepath, e))
+            if os.path.exists(tmp_path):
+                _unlink(tmp_path)
+            return
+        self.evict()
+
+    def evict(self):
+        """Delete the least recently used entries above the size limit"""
+        with self._lock:
+            filenames = set(os.listdir(self.folder))
+            entries = []
+            total_size = 0
+            for filename in filenames:
+                if filename.endswith(('.tmp', '.part', ACCESS_SUFFIX)):
+                    continue
+                path = os.path.join(self.folder, filename)
+                try:
+                    entry_stat = os.stat(path)
+                    last_used = entry_stat.st_mtime
+                    if filename + ACCESS_SUFFIX in filenames:
+                        last_used = max(
+                            last_used,
+                            os.stat(path + ACCESS_SUFFIX).st_mtime)
+                except OSError:
+                    continue
+                entries.append((last_used, entry_stat.st_size, path))
+                total_size += entry_stat.st_size
+            entries.sort()
+            for _, size, path in entries:
+                if total_size <= self.max_size:
+                    break
+                try:
+                    _unlink(path)
+                except OSError:
+                    continue
+                total_size -= size
+                try:
+                    os.unlink(path + ACCESS_SUFFIX)
+                except OSError:
+                    pass
@@ -5,21 +5,21 @@ name and version from public HTML repositories to the dist folder.
 
 The 'upload_all' command scans the content of the `dist` folder for any
 previously generated artifacts that match the current project version number
-and upload them all to PyPI at once.
+and upload them all to PyPI at once. Uploads are dispatched concurrently on
+a bounded thread pool: a failed upload is reported without aborting the
+others.
 
 """
 import os
-try:
-    from configparser import ConfigParser, NoSectionError, NoOptionError
-except ImportError:
-    from ConfigParser import ConfigParser, NoSectionError, NoOptionError
+from configparser import ConfigParser, NoSectionError, NoOptionError
 from distutils.cmd import Command
 from distutils.command.upload import upload
-from distutils.errors import DistutilsOptionError
-from pkg_resources import safe_version
+from distutils.errors import DistutilsOptionError, DistutilsError
+from concurrent.futures import ThreadPoolExecutor, as_completed
 
-from wheelhouse_uploader.utils import parse_filename
+from wheelhouse_uploader.utils import parse_filename, safe_version
 from wheelhouse_uploader.fetch import download_artifacts
+from wheelhouse_uploader.cache import DownloadCache, CACHE_DIR_ENV
 
 __all__ = ['fetch_artifacts', 'upload_all']
 
@@ -31,9 +31,22 @@ KEY = 'artifact_indexes'
 
 class fetch_artifacts(Command):
 
-    user_options = []
+    user_options = [
+        ('python-tag=', None,
+         'only fetch artifacts matching this python tag pattern'),
+        ('abi-tag=', None,
+         'only fetch artifacts matching this abi tag pattern'),
+        ('platform-tag=', None,
+         'only fetch artifacts matching this platform tag pattern'),
+        ('cache-dir=', None,
+         'share downloaded files across fetches with this cache folder'),
+    ]
 
     def initialize_options(self):
+        self.python_tag = None
+        self.abi_tag = None
+        self.platform_tag = None
+        self.cache_dir = os.environ.get(CACHE_DIR_ENV)
         config = ConfigParser()
         try:
             config.read(SETUP_FILE)
@@ -52,12 +65,68 @@ class fetch_artifacts(Command):
         metadata = self.distribution.metadata
         project_name = metadata.get_name()
         version = metadata.get_version()
+        cache = None
+        if self.cache_dir:
+            cache = DownloadCache(self.cache_dir)
         for index_url in self.index_urls:
             download_artifacts(index_url, 'dist', project_name,
-                               version=version, max_workers=4)
+                               version=version, max_workers=4,
+                               python_tag=self.python_tag,
+                               abi_tag=self.abi_tag,
+                               platform_tag=self.platform_tag,
+                               cache=cache)
 
 
 class upload_all(upload):
+    """Upload the artifacts of the current version found in 'dist'
+
+    A failed upload does not prevent the others from completing, the failures
+    are reported at the end:
+
+    >>> import contextlib, io, tempfile
+    >>> from distutils.dist import Distribution
+    >>> from wheelhouse_uploader.fake_index import FakeIndexServer
+    >>> previous_dir = os.getcwd()
+    >>> os.chdir(tempfile.mkdtemp())
+    >>> os.mkdir('dist')
+    >>> for filename in ['proj-1.0.tar.gz', 'proj-1.0-py3-none-any.whl',
+    ...                  'proj-1.0-cp311-cp311-win_amd64.whl',
+    ...                  'proj-0.9.tar.gz']:
+    ...     with open(os.path.join('dist', filename), 'wb') as f:
+    ...         _ = f.write(b'content')
+    >>> with FakeIndexServer(tempfile.mkdtemp(),
+    ...                      fail_patterns=['*win*']) as server:
+    ...     command = upload_all(Distribution({'name': 'proj',
+    ...                                        'version': '1.0'}))
+    ...     command.repository = server.url
+    ...     command.username, command.password = 'user', 'secret'
+    ...     command.max_workers = 2
+    ...     command.ensure_finalized()
+    ...     try:
+    ...         with contextlib.redirect_stdout(io.StringIO()):
+    ...             command.run()
+    ...     except DistutilsError as e:
+    ...         print(e)
+    1 of 3 uploads failed: dist/proj-1.0-cp311-cp311-win_amd64.whl
+    >>> sorted(server.received)
+    ['proj-1.0-py3-none-any.whl', 'proj-1.0.tar.gz']
+    >>> os.chdir(previous_dir)
+
+    """
+
+    user_options = upload.user_options + [
+        ('max-workers=', None, 'maximum number of concurrent uploads'),
+    ]
+
+    def initialize_options(self):
+        upload.initialize_options(self)
+        self.max_workers = 4
+
+    def finalize_options(self):
+        upload.finalize_options(self)
+        self.max_workers = int(self.max_workers)
+        if self.max_workers < 1:
+            raise DistutilsOptionError("--max-workers must be at least 1")
 
     def run(self):
         metadata = self.distribution.metadata
@@ -81,5 +150,26 @@ class upload_all(upload):
             raise DistutilsOptionError(
                 "No file collected from the 'dist' folder")
 
-        for command, pyversion, filepath in dist_files:
-            self.upload_file(command, pyversion, filepath)
+        failures = []
+        with ThreadPoolExecutor(max_workers=self.max_workers) as e:
+            # Dispatch the file uploads in threads
+            futures = dict(
+                (e.submit(self.upload_file, command, pyversion, filepath),
+                 filepath)
+                for command, pyversion, filepath in dist_files)
+            for future in as_completed(futures):
+                filepath = futures[future]
+                try:
+                    future.result()
+                    print("Uploaded %s" % filepath)
+                except Exception as exc:
+                    # Report the failure but let the other uploads proceed
+                    print("Failed to upload %s: %s %s"
+                          % (filepath, type(exc).__name__, exc))
+                    failures.append(filepath)
+
+        if failures:
+            raise DistutilsError(
+                "%d of %d uploads failed: %s"
+                % (len(failures), len(dist_files),
+                   ", ".join(sorted(failures))))
@@ -1,16 +1,20 @@
 import argparse
 import sys
 import os
-from libcloud.common.types import InvalidCredsError
-import libcloud.security
-from wheelhouse_uploader.upload import Uploader
-from wheelhouse_uploader.fetch import download_artifacts
+
+# Note: libcloud and the wheelhouse_uploader submodules are imported lazily in
+# the command handlers to keep the startup time of the command line short,
+# e.g. when the upload is skipped because of a missing secret API key.
 
 
 def parse_args():
     parser = argparse.ArgumentParser(
         description='Manage Python build artifacts',
     )
+    parser.add_argument('--trace', '--profile', metavar='TRACE_FILE',
+                        help='record the duration of the upload or fetch '
+                             'phases in a Chrome trace event JSON file '
+                             '(viewable in chrome://tracing or speedscope)')
     subparsers = parser.add_subparsers(
         title='Commands',
     )
@@ -21,9 +25,23 @@ def parse_args():
     )
     upload.set_defaults(command='upload')
 
-    upload.add_argument('container_name', help='name of the target container')
+    upload.add_argument('destinations', nargs='+', metavar='container_name',
+                        help='name of the target container, optionally '
+                             'prefixed by PROVIDER[@REGION]: to override the '
+                             'default provider and region. Several '
+                             'destinations can be passed to upload the same '
+                             'files to all of them')
     upload.add_argument('--local-folder', default='dist',
                         help='path to the folder to upload')
+    upload.add_argument('--recursive', default=False, action="store_true",
+                        help='also upload the files of the subfolders of '
+                             'the local folder')
+    upload.add_argument('--include', action='append', default=[],
+                        help='only upload files matching this glob pattern '
+                             '(can be repeated)')
+    upload.add_argument('--exclude', action='append', default=[],
+                        help='ignore files and folders matching this glob '
+                             'pattern (can be repeated)')
     upload.add_argument('--username',
                         help='account name for the cloud storage')
     upload.add_argument('--secret',
@@ -43,9 +61,24 @@ def parse_args():
     upload.add_argument('--no-update-index', default=False,
                         action="store_true",
                         help='build an index.html file')
+    upload.add_argument('--watch', default=False, action="store_true",
+                        help='keep watching the local folder and upload '
+                             'new files as soon as they are complete')
+    upload.add_argument('--watch-interval', type=float, default=2.,
+                        help='delay in seconds between two scans of the '
+                             'watched folder')
+    upload.add_argument('--watch-debounce', type=float, default=10.,
+                        help='delay in seconds without new upload before '
+                             'refreshing the metadata and index files')
+    upload.add_argument('--watch-timeout', type=float, default=None,
+                        help='stop watching after this many seconds without '
+                             'any new file (default: watch until '
+                             'interrupted)')
     upload.add_argument('--upload-pull-request', default=False,
                         action="store_true",
                         help='upload even if it is a pull request')
+    upload.add_argument('--no-progress', default=False, action="store_true",
+                        help='do not print the aggregate upload throughput')
 
     # Options for the fetch sub command:
     fetch = subparsers.add_parser(
@@ -57,6 +90,24 @@ def parse_args():
     fetch.add_argument('--version', help='version of the artifact to collect')
     fetch.add_argument('--local-folder', default='dist',
                        help='path to the folder to store fetched items')
+    fetch.add_argument('--cache-dir', nargs='?', const='',
+                       default=os.environ.get('WHEELHOUSE_UPLOADER_CACHE_DIR'),
+                       help='share downloaded files across fetches with a '
+                            'cache folder (default: '
+                            '~/.cache/wheelhouse-uploader)')
+    fetch.add_argument('--cache-max-size', type=float, default=5000,
+                       help='maximum size of the cache folder in MB')
+    fetch.add_argument('--python-tag',
+                       help='only collect artifacts with a matching python '
+                            'tag, e.g. "cp311" or "cp3*,py3"')
+    fetch.add_argument('--abi-tag',
+                       help='only collect artifacts with a matching abi tag, '
+                            'e.g. "cp311" or "abi3"')
+    fetch.add_argument('--platform-tag',
+                       help='only collect artifacts with a matching platform '
+                            'tag, e.g. "manylinux*"')
+    fetch.add_argument('--no-progress', default=False, action="store_true",
+                       help='do not print the aggregate download throughput')
     return parser.parse_args()
 
 
@@ -80,8 +131,65 @@ def check_upload_credentions(options):
         sys.exit(0)
 
 
+def parse_destination(spec, provider_name, region):
+    """Parse a [PROVIDER[@REGION]:]CONTAINER destination specification
+
+    >>> parse_destination('wheelhouse', 'CLOUDFILES', 'ord')
+    ('CLOUDFILES', 'ord', 'wheelhouse')
+    >>> parse_destination('S3:wheelhouse', 'CLOUDFILES', 'ord')
+    ('S3', 'ord', 'wheelhouse')
+    >>> parse_destination('CLOUDFILES@iad:wheelhouse', 'CLOUDFILES', 'ord')
+    ('CLOUDFILES', 'iad', 'wheelhouse')
+
+    """
+    if ':' not in spec:
+        return provider_name, region, spec
+    provider_spec, container_name = spec.split(':', 1)
+    if '@' in provider_spec:
+        provider_name, region = provider_spec.split('@', 1)
+    else:
+        provider_name = provider_spec
+    return provider_name, region, container_name
+
+
+def provider_credentials(options, provider_name):
+    """Credentials for a provider
+
+    The --username/--secret credentials are only used for --provider-name.
+    Destinations on other providers must be configured with the
+    WHEELHOUSE_UPLOADER_<PROVIDER>_USERNAME and _SECRET environment variables
+    so that the credentials of a provider are never sent to another one.
+
+    """
+    if provider_name == options.provider_name:
+        return options.username, options.secret
+    prefix = 'WHEELHOUSE_UPLOADER_%s_' % provider_name.upper()
+    username = os.environ.get(prefix + 'USERNAME')
+    secret = os.environ.get(prefix + 'SECRET')
+    if not username or not secret:
+        print("Credentials required for the %s destinations: set the "
+              "%sUSERNAME and %sSECRET environment variables"
+              % (provider_name, prefix, prefix))
+        sys.exit(1)
+    return username, secret
+
+
+def make_progress(options):
+    if options.no_progress:
+        return None
+    from wheelhouse_uploader.progress import ThroughputPrinter
+    return ThroughputPrinter()
+
+
 def handle_upload(options):
-    check_upload_credentions(options)
+    parsed_destinations = [
+        parse_destination(spec, options.provider_name, options.region)
+        for spec in options.destinations]
+    # The --username/--secret credentials are not needed when all the
+    # destinations are on other providers
+    if any(provider_name == options.provider_name
+           for provider_name, _, _ in parsed_destinations):
+        check_upload_credentions(options)
 
     if (not options.upload_pull_request and
         (os.environ.get('APPVEYOR_PULL_REQUEST_NUMBER')
@@ -92,36 +200,93 @@ def handle_upload(options):
               'requests.')
         sys.exit(0)
 
+    from libcloud.common.types import InvalidCredsError
+    import libcloud.security
+    from wheelhouse_uploader.upload import Uploader, FanOutUploader
+
     if options.no_ssl_check:
         # This is needed when the host OS such as Windows does not make
         # make available a CA cert bundle in a standard location.
         libcloud.security.VERIFY_SSL_CERT = False
 
-    try:
-        uploader = Uploader(options.username, options.secret,
-                            options.provider_name,
-                            region=options.region,
+    progress = make_progress(options)
+    destinations = []
+    for provider_name, region, container_name in parsed_destinations:
+        username, secret = provider_credentials(options, provider_name)
+        uploader = Uploader(username, secret, provider_name,
+                            region=region,
                             update_index=not options.no_update_index,
-                            max_workers=options.max_workers)
-        uploader.upload(options.local_folder, options.container_name)
+                            max_workers=options.max_workers,
+                            recursive=options.recursive,
+                            include=options.include,
+                            exclude=options.exclude,
+                            progress=progress)
+        destinations.append((uploader, container_name))
+
+    if options.watch and len(destinations) > 1:
+        print("--watch only supports a single destination")
+        sys.exit(1)
+
+    try:
+        if len(destinations) > 1:
+            fan_out = FanOutUploader(destinations,
+                                     max_workers=options.max_workers,
+                                     progress=progress)
+            fan_out.upload(options.local_folder)
+        elif options.watch:
+            uploader, container_name = destinations[0]
+            uploader.watch(options.local_folder, container_name,
+                           poll_interval=options.watch_interval,
+                           debounce=options.watch_debounce,
+                           idle_timeout=options.watch_timeout)
+        else:
+            uploader, container_name = destinations[0]
+            uploader.upload(options.local_folder, container_name)
 
         if not options.no_enable_cdn:
-            try:
-                url = uploader.get_container_cdn_url(options.container_name)
-                print('Wheelhouse successfully published at:')
-                print(url)
-            except Exception as e:
-                print("Failed to enable CDN: %s %s" % (type(e).__name__, e))
-    except InvalidCredsError:
-        print("Invalid credentials for user '%s'" % options.username)
+            for uploader, container_name in destinations:
+                try:
+                    url = uploader.get_container_cdn_url(container_name)
+                    print('Wheelhouse successfully published at:')
+                    print(url)
+                except Exception as e:
+                    print("Failed to enable CDN: %s %s"
+                          % (type(e).__name__, e))
+    except InvalidCredsError as e:
+        print("Invalid credentials for %s" % e.value)
         sys.exit(1)
 
 
 def main():
     options = parse_args()
+    if options.trace is None:
+        return run_command(options)
+
+    from wheelhouse_uploader.tracing import span, start_tracing, stop_tracing
+    start_tracing()
+    try:
+        with span(options.command):
+            return run_command(options)
+    finally:
+        stop_tracing(options.trace)
+        print("Trace written to %s" % options.trace)
+
+
+def run_command(options):
     if options.command == 'upload':
         return handle_upload(options)
     elif options.command == 'fetch':
+        from wheelhouse_uploader.fetch import download_artifacts
+        cache = None
+        if options.cache_dir is not None:
+            from wheelhouse_uploader.cache import DownloadCache
+            cache = DownloadCache(options.cache_dir or None,
+                                  max_size=int(options.cache_max_size * 1e6))
         download_artifacts(options.url, options.local_folder,
                            project_name=options.project_name,
-                           version=options.version)
+                           version=options.version,
+                           python_tag=options.python_tag,
+                           abi_tag=options.abi_tag,
+                           platform_tag=options.platform_tag,
+                           cache=cache,
+                           progress=make_progress(options))
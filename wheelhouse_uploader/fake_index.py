@@ -0,0 +1,213 @@
+"""Local stand-in for the PyPI upload endpoint
+
+Accepts the multipart/form-data POST requests emitted by the distutils
+'upload' command (and therefore by 'upload_all') and stores the received
+files in a local folder. This makes it possible to exercise the upload code
+path without talking to PyPI:
+
+    python -m wheelhouse_uploader.fake_index --port 8080 --folder /tmp/recv
+    python setup.py upload_all -r http://127.0.0.1:8080/
+
+Uploads of filenames matching one of the ``fail_patterns`` are rejected with
+a 500 error to simulate per-file server side failures.
+
+The files of the folder are served back on GET requests, with support for
+Range requests, so that the server can also be used as the artifact index of
+``fetch``. Folder URLs are served from their index.html file, or from their
+index.json file to clients asking for the PEP 691 JSON format when
+``negotiate`` is enabled.
+
+"""
+import argparse
+import email
+import os
+import re
+import threading
+from fnmatch import fnmatch
+from http.server import BaseHTTPRequestHandler, HTTPServer
+from socketserver import ThreadingMixIn
+from urllib.parse import unquote
+
+_range_pattern = re.compile(r'^bytes=(\d+)-(\d+)$')
+
+_JSON_CONTENT_TYPE = 'application/vnd.pypi.simple.v1+json'
+
+_content_types = {
+    '.html': 'text/html',
+    '.json': 'application/json',
+}
+
+
+def _parse_upload(content_type, body):
+    """Extract the (filename, content) pair from an upload form"""
+    header = ('Content-Type: %s\r\n\r\n' % content_type).encode('ascii')
+    message = email.message_from_bytes(header + body)
+    for part in message.walk():
+        if part.get_param('name', header='content-disposition') == 'content':
+            return part.get_filename(), part.get_payload(decode=True)
+    raise ValueError('No "content" field in upload form')
+
+
+class _UploadHandler(BaseHTTPRequestHandler):
+
+    def do_POST(self):
+        length = int(self.headers.get('Content-Length', 0))
+        body = self.rfile.read(length)
+        try:
+            filename, content = _parse_upload(
+                self.headers.get('Content-Type'), body)
+        except ValueError as e:
+            self.send_error(400, str(e))
+            return
+        filename = os.path.basename(filename)
+        if any(fnmatch(filename, p) for p in self.server.fail_patterns):
+            self.send_error(500, 'Simulated failure for %s' % filename)
+            return
+        with open(os.path.join(self.server.folder, filename), 'wb') as f:
+            f.write(content)
+        with self.server.lock:
+            self.server.received.append(filename)
+        self.send_response(200)
+        self.end_headers()
+
+    def do_GET(self):
+        path = unquote(self.path.split('?', 1)[0]).lstrip('/')
+        if '..' in path.split('/'):
+            self.send_error(403)
+            return
+        filepath = os.path.join(self.server.folder, *path.split('/'))
+        content_type = None
+        if path == '' or path.endswith('/'):
+            accept = self.headers.get('Accept', '')
+            if (self.server.negotiate and _JSON_CONTENT_TYPE in accept
+                    and os.path.isfile(filepath + 'index.json')):
+                filepath += 'index.json'
+                content_type = _JSON_CONTENT_TYPE
+            else:
+                filepath += 'index.html'
+        if not os.path.isfile(filepath):
+            self.send_error(404)
+            return
+        with open(filepath, 'rb') as f:
+            content = f.read()
+        filename = os.path.basename(filepath)
+        extension = os.path.splitext(filename)[1]
+        headers = [
+            ('Content-Type', content_type or _content_types.get(
+                extension, 'application/octet-stream')),
+            ('Accept-Ranges', 'bytes'),
+            ('Last-Modified',
+             self.date_time_string(os.stat(filepath).st_mtime)),
+        ]
+        with self.server.lock:
+            truncate = self.server.truncate.get(filename, 0) > 0
+            if truncate:
+                self.server.truncate[filename] -= 1
+        match = _range_pattern.match(self.headers.get('Range', ''))
+        if truncate:
+            # Announce the full content in a single chunk and drop the
+            # connection after the first tenth of it
+            self.send_response(200)
+            for header in headers:
+                self.send_header(*header)
+            self.send_header('Transfer-Encoding', 'chunked')
+            self.end_headers()
+            self.wfile.write(('%x\r\n' % len(content)).encode('ascii'))
+            self.wfile.write(content[:len(content) // 10])
+            self.close_connection = True
+            return
+        if match is not None and filename not in self.server.ignore_ranges:
+            start, end = int(match.group(1)), int(match.group(2))
+            content = content[start:end + 1]
+            self.send_response(206)
+            self.send_header('Content-Range', 'bytes %d-%d/%d'
+                             % (start, start + len(content) - 1,
+                                os.path.getsize(filepath)))
+        else:
+            self.send_response(200)
+        for header in headers:
+            self.send_header(*header)
+        self.send_header('Content-Length', str(len(content)))
+        self.end_headers()
+        self.wfile.write(content)
+
+    def log_message(self, format, *args):
+        if self.server.verbose:
+            BaseHTTPRequestHandler.log_message(self, format, *args)
+
+
+class FakeIndexServer(ThreadingMixIn, HTTPServer):
+    """Threaded HTTP server emulating the PyPI legacy upload API
+
+    Range requests for the filenames in ``ignore_ranges`` are answered with
+    the full content, as by servers that do not support them. ``truncate``
+    maps filenames to the number of upcoming downloads of that file to cut
+    short, to simulate dropped connections.
+
+    Can be used as a context manager that serves requests in a background
+    thread:
+
+    >>> import tempfile
+    >>> with FakeIndexServer(tempfile.mkdtemp()) as server:
+    ...     server.url                                    # doctest: +ELLIPSIS
+    'http://127.0.0.1:.../'
+
+    """
+    daemon_threads = True
+
+    def __init__(self, folder, host='127.0.0.1', port=0, fail_patterns=(),
+                 verbose=False):
+        HTTPServer.__init__(self, (host, port), _UploadHandler)
+        self.folder = folder
+        self.fail_patterns = list(fail_patterns)
+        self.verbose = verbose
+        self.received = []
+        self.ignore_ranges = set()
+        self.truncate = {}
+        self.negotiate = False
+        self.lock = threading.Lock()
+        self._thread = None
+
+    @property
+    def url(self):
+        host, port = self.server_address[:2]
+        return 'http://%s:%d/' % (host, port)
+
+    def __enter__(self):
+        self._thread = threading.Thread(target=self.serve_forever)
+        self._thread.daemon = True
+        self._thread.start()
+        return self
+
+    def __exit__(self, *exc_info):
+        self.shutdown()
+        self.server_close()
+        self._thread.join()
+
+
+def main():
+    parser = argparse.ArgumentParser(
+        description='Local stand-in for the PyPI upload endpoint')
+    parser.add_argument('--host', default='127.0.0.1')
+    parser.add_argument('--port', type=int, default=8080)
+    parser.add_argument('--folder', default='.',
+                        help='folder where to store the uploaded files')
+    parser.add_argument('--fail', action='append', default=[],
+                        help='reject uploads matching this filename pattern')
+    options = parser.parse_args()
+    if not os.path.exists(options.folder):
+        os.makedirs(options.folder)
+    server = FakeIndexServer(options.folder, host=options.host,
+                             port=options.port, fail_patterns=options.fail,
+                             verbose=True)
+    print('Accepting uploads at %s' % server.url)
+    try:
+        server.serve_forever()
+    except KeyboardInterrupt:
+        pass
+    finally:
+        server.server_close()
+
+
+if __name__ == '__main__':
+    main()
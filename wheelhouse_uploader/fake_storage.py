@@ -0,0 +1,238 @@
+"""In-memory stand-in for a CloudFiles storage account
+
+FakeCloudFilesDriver is the libcloud CloudFiles driver with its connection
+replaced by an in-memory mock. The upload code paths (streamed uploads,
+checksum verification, retries) run unmodified against it, without network
+access. Uploads of the objects listed in ``fail`` or ``corrupt`` fail or
+return a checksum that does not match the uploaded content, to simulate
+server side errors and corrupted transfers:
+
+>>> import os, tempfile
+>>> from libcloud.storage.types import ObjectHashMismatchError
+>>> filepath = os.path.join(tempfile.mkdtemp(), 'a.whl')
+>>> with open(filepath, 'wb') as f:
+...     _ = f.write(b'content')
+>>> store = FakeCloudFilesStore()
+>>> store.corrupt['a.whl'] = 1  # corrupt the first upload of a.whl only
+>>> driver = FakeCloudFilesDriver(store)
+>>> container = driver.get_container('wheelhouse')
+>>> try:
+...     driver.upload_object(filepath, container, 'a.whl')
+... except ObjectHashMismatchError as e:
+...     print(e.object_name)
+a.whl
+>>> obj = driver.upload_object(filepath, container, 'a.whl')
+>>> obj.hash == md5(b'content').hexdigest()
+True
+>>> [o.name for o in driver.iterate_container_objects(container)]
+['a.whl']
+
+"""
+import json
+from hashlib import md5
+from urllib.parse import unquote
+
+from libcloud.common.types import LibcloudError
+from libcloud.storage.drivers.cloudfiles import CloudFilesStorageDriver
+
+from wheelhouse_uploader.upload import Uploader
+
+
+class FakeCloudFilesStore(object):
+    """Objects of the fake containers and failures to simulate
+
+    ``fail`` and ``corrupt`` map object names to the number of upcoming
+    uploads of that object that should fail or be corrupted.
+
+    """
+
+    def __init__(self):
+        self.objects = {}  # (container, name) -> content
+        self.fail = {}
+        self.corrupt = {}
+        self.puts = []  # names of the uploaded objects, in order
+
+
+class _FakeRawResponse(object):
+
+    def __init__(self, content):
+        self.content = content
+
+    def iter_content(self, chunk_size):
+        for i in range(0, len(self.content), chunk_size):
+            yield self.content[i:i + chunk_size]
+
+
+class _FakeResponse(object):
+
+    def __init__(self, status, headers=None, body='', content=b''):
+        self.status = status
+        self.headers = headers or {}
+        self.body = body
+        self._response = _FakeRawResponse(content)
+
+    def success(self):
+        return 200 <= self.status < 300
+
+
+def _read_payload(data):
+    if hasattr(data, 'read'):
+        return data.read()
+    if isinstance(data, bytes):
+        return data
+    # Consume a streamed upload the way the HTTP client does
+    return b''.join(data)
+
+
+class FakeCloudFilesConnection(object):
+    """Mock of the CloudFiles connection backed by a FakeCloudFilesStore"""
+
+    def __init__(self, store):
+        self.store = store
+
+    def request(self, action, params=None, data='', headers=None,
+                method='GET', raw=False, cdn_request=False):
+        parts = action.strip('/').split('/', 1)
+        container = unquote(parts[0])
+        name = unquote(parts[1]) if len(parts) > 1 else None
+        if name is None and method == 'HEAD':
+            return _FakeResponse(204, {'x-container-object-count': '0',
+                                       'x-container-bytes-used': '0'})
+        elif name is None and method == 'GET':
+            return self._list(container, params or {})
+        elif method in ('HEAD', 'GET'):
+            content = self.store.objects.get((container, name))
+            if content is None:
+                return _FakeResponse(404)
+            return _FakeResponse(200, {'content-length': str(len(content)),
+                                       'etag': md5(content).hexdigest()},
+                                 content=content)
+        elif method == 'PUT':
+            return self._put(container, name, _read_payload(data))
+        elif method == 'DELETE':
+            self.store.objects.pop((container, name), None)
+            return _FakeResponse(204)
+        raise LibcloudError('Unsupported fake request: %s %s'
+                            % (method, action))
+
+    def _list(self, container, params):
+        prefix = params.get('prefix', '')
+        marker = params.get('marker', '')
+        listing = [
+            {'name': name, 'bytes': len(content),
+             'hash': md5(content).hexdigest(),
+             'content_type': 'application/octet-stream',
+             'last_modified': '2017-01-01T00:00:00.000000'}
+            for (c, name), content in sorted(self.store.objects.items())
+            if c == container and name.startswith(prefix) and name > marker]
+        return _FakeResponse(200, body=json.dumps(listing))
+
+    def _put(self, container, name, content):
+        self.store.puts.append(name)
+        if self.store.fail.get(name, 0) > 0:
+            self.store.fail[name] -= 1
+            raise LibcloudError('Simulated failure for %s' % name)
+        if self.store.corrupt.get(name, 0) > 0:
+            self.store.corrupt[name] -= 1
+            content = content[:-1]
+        self.store.objects[(container, name)] = content
+        return _FakeResponse(201, {'etag': md5(content).hexdigest()})
+
+
+class FakeCloudFilesDriver(CloudFilesStorageDriver):
+    """CloudFiles driver storing the objects in a FakeCloudFilesStore"""
+
+    def __init__(self, store):
+        CloudFilesStorageDriver.__init__(self, 'user', 'key', region='ord')
+        self.connection = FakeCloudFilesConnection(store)
+
+
+class FakeCloudFilesUploader(Uploader):
+    """Uploader to the fake CloudFiles containers of a FakeCloudFilesStore
+
+    >>> import os, tempfile
+    >>> filepath = os.path.join(tempfile.mkdtemp(), 'a.whl')
+    >>> with open(filepath, 'wb') as f:
+    ...     _ = f.write(b'content')
+    >>> store = FakeCloudFilesStore()
+    >>> uploader = FakeCloudFilesUploader(store)
+    >>> metadata = uploader.upload_file(filepath, 'wheelhouse')
+    ...                                                   # doctest: +ELLIPSIS
+    Uploading .../a.whl [0.000 MB]
+    >>> store.objects[('wheelhouse', 'a.whl')]
+    b'content'
+    >>> uploader._report_verification()
+    Verified 1/1 uploaded files against the checksums returned by the provider
+
+    A corrupted upload is detected and only the affected file is uploaded
+    again:
+
+    >>> store.corrupt['a.whl'] = 1
+    >>> metadata = uploader.upload_file(filepath, 'wheelhouse')
+    ...                                                   # doctest: +ELLIPSIS
+    Uploading .../a.whl [0.000 MB]
+    Checksum mismatch for a.whl: MD5 hash checksum does not match ...
+    Uploading .../a.whl [0.000 MB]
+    >>> store.puts
+    ['a.whl', 'a.whl', 'a.whl']
+    >>> store.objects[('wheelhouse', 'a.whl')]
+    b'content'
+    >>> uploader._report_verification()
+    Verified 1/1 uploaded files against the checksums returned by the provider \
+(1 re-uploaded)
+
+    Uploading to several destinations streams the file once to all of them.
+    A failed or corrupted upload is retried on the affected destination
+    only:
+
+    >>> from wheelhouse_uploader.upload import FanOutUploader
+    >>> first, second = FakeCloudFilesStore(), FakeCloudFilesStore()
+    >>> first.fail['a.whl'] = 1
+    >>> second.corrupt['a.whl'] = 1
+    >>> third = FakeCloudFilesStore()
+    >>> fan_out = FanOutUploader([(FakeCloudFilesUploader(first), 'wh'),
+    ...                           (FakeCloudFilesUploader(second), 'wh'),
+    ...                           (FakeCloudFilesUploader(third), 'wh')])
+    >>> metadata = fan_out.upload_file(filepath)          # doctest: +ELLIPSIS
+    Uploading .../a.whl [0.000 MB] to 3 destinations
+    Failed to upload .../a.whl to CLOUDFILES:wh: LibcloudError ...
+    Uploading .../a.whl to CLOUDFILES:wh again
+    Uploading .../a.whl [0.000 MB]
+    Checksum mismatch for a.whl on CLOUDFILES:wh: MD5 hash checksum ...
+    Uploading .../a.whl to CLOUDFILES:wh again
+    Uploading .../a.whl [0.000 MB]
+    >>> [len(store.puts) for store in (first, second, third)]
+    [2, 2, 1]
+    >>> [store.objects[('wh', 'a.whl')] for store in (first, second, third)]
+    [b'content', b'content', b'content']
+    >>> for uploader, _ in fan_out.destinations:
+    ...     uploader._report_verification()
+    Verified 1/1 uploaded files against the checksums returned by the provider
+    Verified 1/1 uploaded files against the checksums returned by the provider \
+(1 re-uploaded)
+    Verified 1/1 uploaded files against the checksums returned by the provider
+
+    The reports of the destinations are labeled as they are refreshed
+    concurrently:
+
+    >>> folder = tempfile.mkdtemp()
+    >>> with open(os.path.join(folder, 'a-1.0-py3-none-any.whl'), 'wb') as f:
+    ...     _ = f.write(b'content')
+    >>> store = FakeCloudFilesStore()
+    >>> fan_out = FanOutUploader([(FakeCloudFilesUploader(store), 'wh')])
+    >>> fan_out.upload(folder)                            # doctest: +ELLIPSIS
+    About to upload 1 files to 1 destinations
+    Uploading .../a-1.0-py3-none-any.whl [0.000 MB] to 1 destinations
+    CLOUDFILES:wh: Verified 1/1 uploaded files against the checksums ...
+    CLOUDFILES:wh: Uploading metadata.json with 1 entries
+    CLOUDFILES:wh: Updating index.html with 1 links
+    CLOUDFILES:wh: Updating index.json with 1 files
+
+    """
+
+    def __init__(self, store, **kwargs):
+        Uploader.__init__(self, 'user', 'key', 'CLOUDFILES', 'ord', **kwargs)
+        self.store = store
+
+    def _create_driver(self):
+        return FakeCloudFilesDriver(self.store)
@@ -1,70 +1,492 @@
-try:
-    from urllib.request import urlopen
-    from urllib.parse import urlparse
-except ImportError:
-    # Python 2 compat
-    from urllib2 import urlopen
-    from urlparse import urlparse
+from urllib.request import urlopen, Request
+from urllib.parse import urlparse
+from http.client import HTTPException
 import re
 import os
+import json
 import shutil
-from pkg_resources import safe_version
+from email.utils import mktime_tz, parsedate_tz
 from concurrent.futures import ThreadPoolExecutor, as_completed
-from wheelhouse_uploader.utils import parse_filename
+from wheelhouse_uploader.utils import parse_filename, safe_version
+from wheelhouse_uploader.utils import match_tags
+from wheelhouse_uploader.cache import file_sha256
+from wheelhouse_uploader.progress import ProgressListener, ProgressTracker
+from wheelhouse_uploader.tracing import span
 
 link_pattern = re.compile(r'\bhref="([^"]+)"')
 
+sha256_fragment_pattern = re.compile(r'\bsha256=([0-9a-fA-F]{64})\b')
 
-def download(url, filepath, buffer_size=int(1e6), overwrite=False):
+# PEP 691 JSON simple API
+JSON_INDEX_FILENAME = 'index.json'
+
+JSON_CONTENT_TYPES = ('application/vnd.pypi.simple.v1+json',
+                      'application/json')
+
+ACCEPT_HEADER = ('application/vnd.pypi.simple.v1+json, '
+                 'text/html;q=0.2')
+
+
+def _byte_ranges(size, n_segments):
+    """Split size bytes into contiguous inclusive (start, end) ranges
+
+    >>> _byte_ranges(10, 3)
+    [(0, 3), (4, 7), (8, 9)]
+    >>> _byte_ranges(8, 2)
+    [(0, 3), (4, 7)]
+
+    """
+    segment_size = -(-size // n_segments)
+    return [(start, min(start + segment_size, size) - 1)
+            for start in range(0, size, segment_size)]
+
+
+def _download_range(url, tmp_filepath, start, end, buffer_size, tracker,
+                    name, remote=None):
+    """Write the bytes start to end (inclusive) of url at the same offsets
+
+    If remote is provided, it is expected to be an already opened response
+    stream positioned at start.
+
+    """
+    with span('download_range', start=start, end=end):
+        if remote is None:
+            byte_range = 'bytes=%d-%d' % (start, end)
+            request = Request(url, headers={'Range': byte_range})
+            remote = urlopen(request)
+            if remote.getcode() != 206:
+                remote.close()
+                raise IOError('Range request not honored for %s' % url)
+        try:
+            remaining = end - start + 1
+            with open(tmp_filepath, 'r+b') as f:
+                f.seek(start)
+                while remaining > 0:
+                    data = remote.read(min(buffer_size, remaining))
+                    if not data:
+                        break
+                    f.write(data)
+                    remaining -= len(data)
+                    tracker.update(name, len(data))
+        finally:
+            remote.close()
+        if remaining != 0:
+            raise IOError('Incomplete download of bytes %d-%d of %s'
+                          % (start, end, url))
+
+
+def _download_segments(url, remote, tmp_filepath, size, n_segments,
+                       buffer_size, tracker, name):
+    with open(tmp_filepath, 'wb') as f:
+        f.truncate(size)
+    ranges = _byte_ranges(size, n_segments)
+    (first_start, first_end), other_ranges = ranges[0], ranges[1:]
+    with ThreadPoolExecutor(max_workers=len(other_ranges)) as e:
+        futures = [e.submit(_download_range, url, tmp_filepath, start, end,
+                            buffer_size, tracker, name)
+                   for start, end in other_ranges]
+        # Reuse the already opened response for the first segment
+        _download_range(url, tmp_filepath, first_start, first_end,
+                        buffer_size, tracker, name, remote=remote)
+        for future in as_completed(futures):
+            future.result()
+
+
+def _download_stream(remote, tmp_filepath, buffer_size, tracker, name):
+    with open(tmp_filepath, 'wb') as f:
+        data = remote.read(buffer_size)
+        while data:
+            f.write(data)
+            tracker.update(name, len(data))
+            data = remote.read(buffer_size)
+
+
+def download(url, filepath, buffer_size=int(1e6), overwrite=False,
+             size=None, segment_size=int(16e6), max_segments=4,
+             sha256=None, cache=None, tracker=None):
+    """Download url to filepath through a temporary .part file
+
+    Large files are split into byte ranges of at least segment_size bytes
+    that are fetched concurrently (at most max_segments at a time) if the
+    server advertises support for Range requests. The expected size can be
+    passed when known from the index metadata, otherwise the Content-Length
+    header of the response is used.
+
+    If the expected sha256 digest is provided, the content of the downloaded
+    file is checked against it.
+
+    If a DownloadCache is provided, the file is linked from the cache when
+    available and added to the cache after download otherwise. Files with
+    neither a known sha256 digest nor a known size are not cached.
+
+    The progress of the download is reported to tracker (a ProgressTracker)
+    if provided. Files that are not downloaded (already existing or fetched
+    from the cache) are not reported and a download that does not match the
+    expected sha256 digest is reported as failed:
+
+    >>> import tempfile
+    >>> class Recorder(ProgressListener):
+    ...     def on_finish(self, name, transferred, error=None):
+    ...         print('%s: %d bytes, %s' % (os.path.basename(name),
+    ...               transferred, 'failed' if error else 'done'))
+    >>> folder = tempfile.mkdtemp()
+    >>> url = 'file://' + os.path.join(folder, 'src.whl')
+    >>> with open(os.path.join(folder, 'src.whl'), 'wb') as f:
+    ...     _ = f.write(b'content')
+    >>> tracker = ProgressTracker(Recorder())
+    >>> download(url, os.path.join(folder, 'a.whl'), tracker=tracker)
+    ...                                                   # doctest: +ELLIPSIS
+    downloading file://.../src.whl
+    a.whl: 7 bytes, done
+    >>> download(url, os.path.join(folder, 'a.whl'), tracker=tracker)
+    ...                                                   # doctest: +ELLIPSIS
+    /.../a.whl already exists
+    >>> try:
+    ...     download(url, os.path.join(folder, 'b.whl'), sha256='0' * 64,
+    ...              tracker=tracker)
+    ... except IOError as e:
+    ...     print(str(e)[:15])                            # doctest: +ELLIPSIS
+    downloading file://.../src.whl
+    b.whl: 7 bytes, failed
+    sha256 mismatch
+    >>> stats = tracker.stats()
+    >>> stats.total, stats.transferred, stats.n_finished, stats.n_failed
+    (14, 14, 2, 1)
+
+    A segmented download falls back to a single stream when the server does
+    not honor a Range request, when the connection is dropped or when the
+    expected size does not match the Content-Length of the response:
+
+    >>> from wheelhouse_uploader.fake_index import FakeIndexServer
+    >>> content = b'0123456789' * 1000
+    >>> with open(os.path.join(folder, 'big.whl'), 'wb') as f:
+    ...     _ = f.write(content)
+    >>> def fetch(server, name, size=None):
+    ...     download(server.url + 'big.whl', os.path.join(folder, name),
+    ...              size=size, segment_size=3000)
+    >>> with FakeIndexServer(folder) as server:
+    ...     fetch(server, 'c.whl')
+    ...     server.ignore_ranges.add('big.whl')
+    ...     fetch(server, 'd.whl')
+    ...     server.ignore_ranges.clear()
+    ...     server.truncate['big.whl'] = 1
+    ...     fetch(server, 'e.whl', size=len(content))
+    ...     fetch(server, 'f.whl', size=len(content) + 1)
+    ...                         # doctest: +ELLIPSIS +NORMALIZE_WHITESPACE
+    downloading http://127.0.0.1:.../big.whl in 3 segments
+    downloading http://127.0.0.1:.../big.whl in 3 segments
+    segmented download of http://127.0.0.1:.../big.whl failed (Range request
+    not honored for http://127.0.0.1:.../big.whl), retrying as a single stream
+    downloading http://127.0.0.1:.../big.whl in 3 segments
+    segmented download of http://127.0.0.1:.../big.whl failed
+    (IncompleteRead(...)), retrying as a single stream
+    expected 10001 bytes for http://127.0.0.1:.../big.whl, got a
+    Content-Length of 10000
+    downloading http://127.0.0.1:.../big.whl
+    >>> for name in 'cdef':
+    ...     with open(os.path.join(folder, name + '.whl'), 'rb') as f:
+    ...         print(name, f.read() == content)
+    c True
+    d True
+    e True
+    f True
+
+    """
+    if tracker is None:
+        tracker = ProgressTracker(ProgressListener())
+    with span('download', file=filepath):
+        _download(url, filepath, buffer_size, overwrite, size, segment_size,
+                  max_segments, sha256, cache, tracker)
+
+
+def _download(url, filepath, buffer_size, overwrite, size, segment_size,
+              max_segments, sha256, cache, tracker):
     if not overwrite and os.path.exists(filepath):
         print('%s already exists' % filepath)
         return
-    print('downloading %s' % url)
+    if cache is not None and sha256 is not None:
+        with span('cache_fetch'):
+            hit = cache.fetch(cache.key(url, sha256=sha256), filepath)
+        if hit:
+            print('%s fetched from cache' % filepath)
+            return
     tmp_filepath = filepath + '.part'
-    with open(tmp_filepath, 'wb') as f:
+    with span('open_url', url=url):
         remote = urlopen(url)
-        try:
-            data = remote.read(buffer_size)
-            while data:
-                f.write(data)
-                data = remote.read(buffer_size)
-        finally:
-            if hasattr(remote, 'close'):
-                remote.close()
+    try:
+        headers = remote.info()
+        segmentable = headers.get('Accept-Ranges', '').lower() == 'bytes'
+        if headers.get('Content-Length'):
+            content_length = int(headers.get('Content-Length'))
+            if size is not None and size != content_length:
+                # Stale index metadata or a different file served under
+                # the same URL: the byte ranges cannot be trusted
+                print('expected %d bytes for %s, got a Content-Length of '
+                      '%d' % (size, url, content_length))
+                segmentable = False
+            size = content_length
+        if cache is not None and sha256 is None and size is None:
+            # Nothing to tell apart different files published under the
+            # same URL
+            cache = None
+        if cache is not None:
+            cache_key = cache.key(url, sha256=sha256, size=size)
+            if sha256 is None:
+                with span('cache_fetch'):
+                    hit = cache.fetch(cache_key, filepath)
+                if hit:
+                    print('%s fetched from cache' % filepath)
+                    return
+        n_segments = 1
+        if size and segmentable:
+            n_segments = max(1, min(max_segments, size // segment_size))
+        if size is not None:
+            # Only the files actually downloaded count in the total
+            tracker.expect(size)
+        with tracker.transfer(filepath, size), \
+                span('transfer', size=size, n_segments=n_segments):
+            if n_segments > 1:
+                print('downloading %s in %d segments' % (url, n_segments))
+                try:
+                    _download_segments(url, remote, tmp_filepath, size,
+                                       n_segments, buffer_size, tracker,
+                                       filepath)
+                except (IOError, HTTPException) as e:
+                    # HTTPException (e.g. IncompleteRead when a connection
+                    # is closed early) is not an IOError
+                    print('segmented download of %s failed (%s), retrying '
+                          'as a single stream' % (url, e))
+                    remote.close()
+                    tracker.restart(filepath)
+                    remote = urlopen(url)
+                    _download_stream(remote, tmp_filepath, buffer_size,
+                                     tracker, filepath)
+            else:
+                print('downloading %s' % url)
+                _download_stream(remote, tmp_filepath, buffer_size, tracker,
+                                 filepath)
+            if sha256 is not None:
+                # A corrupted download is reported as a failed transfer
+                with span('hash'):
+                    digest = file_sha256(tmp_filepath,
+                                         buffer_size=buffer_size)
+                if digest != sha256.lower():
+                    os.unlink(tmp_filepath)
+                    raise IOError('sha256 mismatch for %s: expected %s, '
+                                  'got %s' % (url, sha256, digest))
+    finally:
+        if hasattr(remote, 'close'):
+            remote.close()
     # download was successful: rename to the final name:
     if os.path.exists(filepath):
         os.unlink(filepath)
     shutil.move(tmp_filepath, filepath)
+    if cache is not None:
+        with span('cache_store'):
+            cache.store(cache_key, filepath)
 
 
-def _parse_html(index_url, folder, project_name, version=None):
-    # TODO: use correct encoding
-    html_content = urlopen(index_url).read().decode('utf-8')
-    artifacts = []
-    found_versions = set()
+def _resolve_url(index_url, link):
+    if '://' in link:
+        return link
+    elif link.startswith("/"):
+        parsed_index_url = urlparse(index_url)
+        return "%s://%s%s" % (parsed_index_url.scheme,
+                              parsed_index_url.netloc,
+                              link)
+    elif index_url.endswith('/'):
+        return index_url + link
+    elif index_url.endswith(('.html', '.json')):
+        return index_url.rsplit('/', 1)[0] + '/' + link
+    else:
+        return index_url + '/' + link
+
+
+def _json_index_url(index_url):
+    """URL of the JSON index published next to an HTML index page
+
+    Only the index.html page of a folder (or the folder itself) has a JSON
+    counterpart: other HTML pages of the same folder can list other files.
+
+    >>> _json_index_url('http://example.org/wheelhouse/')
+    'http://example.org/wheelhouse/index.json'
+    >>> _json_index_url('http://example.org/wheelhouse/index.html')
+    'http://example.org/wheelhouse/index.json'
+    >>> _json_index_url('http://example.org/wheelhouse') is None
+    False
+    >>> _json_index_url('http://example.org/wheelhouse/project.html') is None
+    True
+
+    """
+    path = urlparse(index_url).path
+    page = path.rsplit('/', 1)[-1]
+    if page not in ('', 'index.html') and '.' in page:
+        return None
+    return _resolve_url(index_url, JSON_INDEX_FILENAME)
+
+
+def _html_entries(index_url, html_content):
     for match in re.finditer(link_pattern, html_content):
         link = match.group(1)
-        if link.startswith("/"):
-            parsed_index_url = urlparse(index_url)
-            url = "%s://%s%s" % (parsed_index_url.scheme,
-                                 parsed_index_url.netloc,
-                                 link)
-        elif index_url.endswith('/'):
-            url = index_url + link
-        elif index_url.endswith('.html'):
-            url = index_url.rsplit('/', 1)[0] + '/' + link
-        else:
-            url = index_url + '/' + link
+        url = _resolve_url(index_url, link)
+        info = {}
         if '#' in link:
-            # TODO: parse digest info to detect any file content corruption
-            link, _ = link.split('#', 1)
+            link, fragment = link.split('#', 1)
+            digest_match = sha256_fragment_pattern.search(fragment)
+            if digest_match is not None:
+                info['sha256'] = digest_match.group(1)
         if '/' in link:
             _, filename = link.rsplit('/', 1)
         else:
             filename = link
+        yield url, filename, info
+
+
+def _json_entries(index_url, json_content):
+    """Parse a PEP 691 JSON project page"""
+    for file_info in json_content.get('files', []):
+        filename = file_info['filename']
+        url = _resolve_url(index_url, file_info.get('url', filename))
+        info = {}
+        sha256 = file_info.get('hashes', {}).get('sha256')
+        if sha256 is not None:
+            info['sha256'] = sha256
+        if file_info.get('size') is not None:
+            info['size'] = file_info['size']
+        yield url, filename, info
+
+
+def _is_json_response(response):
+    content_type = response.info().get('Content-Type', '')
+    return content_type.split(';')[0].strip() in JSON_CONTENT_TYPES
+
+
+def _read_json(response):
+    return json.loads(response.read().decode('utf-8'))
+
+
+# Errors raised when parsing a malformed JSON index
+_JSON_INDEX_ERRORS = (ValueError, KeyError, TypeError, AttributeError)
+
+
+def _last_modified(response):
+    """Timestamp of the Last-Modified header of response, if any"""
+    parsed = parsedate_tz(response.info().get('Last-Modified', ''))
+    if parsed is None:
+        return None
+    return mktime_tz(parsed)
+
+
+def _read_html(index_url, response=None):
+    if response is None:
+        request = Request(index_url, headers={'Accept': 'text/html'})
+        with span('open_url', url=index_url):
+            response = urlopen(request)
+    try:
+        # TODO: use correct encoding
+        return response.read().decode('utf-8')
+    finally:
+        response.close()
+
+
+def _fetch_index_entries(index_url):
+    """Collect the (url, filename, info) entries listed on an index
+
+    The PEP 691 JSON representation of the index is preferred when the
+    server provides it, either through content negotiation or as an
+    index.json file published next to the HTML page. The index.json file is
+    ignored if it is older than the HTML page. Otherwise the links of the
+    HTML page are parsed.
+
+    >>> import tempfile, time
+    >>> from wheelhouse_uploader.fake_index import FakeIndexServer
+    >>> folder = tempfile.mkdtemp()
+    >>> with open(os.path.join(folder, 'index.html'), 'w') as f:
+    ...     _ = f.write('<a href="a-1.0.tar.gz#sha256=%s">a</a>' % ('0' * 64))
+    >>> def publish_json(content, age):
+    ...     filepath = os.path.join(folder, 'index.json')
+    ...     with open(filepath, 'w') as f:
+    ...         _ = f.write(content)
+    ...     timestamp = time.time() - age
+    ...     os.utime(filepath, (timestamp, timestamp))
+    >>> def show(server):
+    ...     for url, filename, info in _fetch_index_entries(server.url):
+    ...         print(filename, sorted(info))
+    >>> json_index = json.dumps({'files': [
+    ...     {'filename': 'a-1.1.tar.gz', 'hashes': {}, 'size': 3}]})
+    >>> with FakeIndexServer(folder) as server:
+    ...     show(server)
+    ...     publish_json(json_index, age=0)
+    ...     show(server)
+    ...     publish_json(json_index, age=3600)
+    ...     show(server)                                  # doctest: +ELLIPSIS
+    ...     publish_json('{"files": [', age=0)
+    ...     show(server)
+    a-1.0.tar.gz ['sha256']
+    a-1.1.tar.gz ['size']
+    Ignoring http://127.0.0.1:.../index.json: older than the HTML index
+    a-1.0.tar.gz ['sha256']
+    a-1.0.tar.gz ['sha256']
+
+    The JSON index negotiated with the server is used unless malformed:
+
+    >>> with FakeIndexServer(folder) as server:
+    ...     server.negotiate = True
+    ...     show(server)                                  # doctest: +ELLIPSIS
+    ...     publish_json(json_index, age=3600)
+    ...     show(server)
+    Malformed JSON index at http://127.0.0.1:.../ (...): using the HTML links
+    a-1.0.tar.gz ['sha256']
+    a-1.1.tar.gz ['size']
+
+    """
+    request = Request(index_url, headers={'Accept': ACCEPT_HEADER})
+    with span('open_url', url=index_url):
+        response = urlopen(request)
+    if _is_json_response(response):
+        try:
+            try:
+                return list(_json_entries(index_url, _read_json(response)))
+            finally:
+                response.close()
+        except _JSON_INDEX_ERRORS as e:
+            print('Malformed JSON index at %s (%s): using the HTML links'
+                  % (index_url, e))
+            return list(_html_entries(index_url, _read_html(index_url)))
+    html_modified = _last_modified(response)
+    html_content = _read_html(index_url, response)
+
+    json_index_url = _json_index_url(index_url)
+    if json_index_url is None:
+        return list(_html_entries(index_url, html_content))
+    try:
+        with span('open_url', url=json_index_url):
+            response = urlopen(json_index_url)
         try:
-            _, file_version, _, _ = parse_filename(filename,
-                                                   project_name=project_name)
+            json_modified = _last_modified(response)
+            if (html_modified is not None and json_modified is not None
+                    and json_modified < html_modified):
+                # Left behind by a publisher that only updates the HTML page
+                print('Ignoring %s: older than the HTML index'
+                      % json_index_url)
+                return list(_html_entries(index_url, html_content))
+            json_content = _read_json(response)
+        finally:
+            response.close()
+        return list(_json_entries(index_url, json_content))
+    except (IOError,) + _JSON_INDEX_ERRORS:
+        # No usable JSON index published next to the HTML page
+        return list(_html_entries(index_url, html_content))
+
+
+def _parse_index(index_url, folder, project_name, version=None,
+                 tag_filters=None):
+    artifacts = []
+    found_versions = set()
+    for url, filename, info in _fetch_index_entries(index_url):
+        try:
+            _, file_version, _, _, tags = parse_filename(
+                filename, project_name=project_name, return_tags=True)
         except ValueError:
             # not a supported artifact
             continue
@@ -73,33 +495,70 @@ def _parse_html(index_url, folder, project_name, version=None):
             found_versions.add(file_version)
             continue
 
-        artifacts.append((url, os.path.join(folder, filename)))
+        if tag_filters and not match_tags(tags, **tag_filters):
+            continue
+
+        artifacts.append((url, os.path.join(folder, filename), info))
     return artifacts, list(sorted(found_versions))
 
 
 def download_artifacts(index_url, folder, project_name, version=None,
-                       max_workers=4):
+                       max_workers=4, python_tag=None, abi_tag=None,
+                       platform_tag=None, cache=None, progress=None):
+    """Download the artifacts of a project listed on an index page
+
+    The index can be an HTML page with links to the artifacts or a PEP 691
+    JSON project page.
+
+    Artifacts can be filtered by version and by glob-style patterns on the
+    python, abi and platform tags of their filenames (see
+    wheelhouse_uploader.utils.match_tags).
+
+    Pass a wheelhouse_uploader.cache.DownloadCache instance as cache to
+    share the downloaded files across fetches.
+
+    Pass a wheelhouse_uploader.progress.ProgressListener instance as progress
+    to be notified of the progress of the downloads.
+
+    """
     if version is not None:
         version = safe_version(version)
-    artifacts, found_versions = _parse_html(index_url, folder, project_name,
-                                            version=version)
+    tag_filters = dict(python=python_tag, abi=abi_tag, platform=platform_tag)
+    with span('parse_index', url=index_url):
+        artifacts, found_versions = _parse_index(index_url, folder,
+                                                 project_name,
+                                                 version=version,
+                                                 tag_filters=tag_filters)
     if not artifacts:
         print('Could not find any matching artifact for project "%s" on %s'
               % (project_name, index_url))
         if version is not None:
             print("Requested version: %s" % version)
             print("Available versions: %s" % ", ".join(sorted(found_versions)))
+        for key, pattern in sorted(tag_filters.items()):
+            if pattern is not None:
+                print("Requested %s tag: %s" % (key, pattern))
         return
 
     print('Found %d artifacts to download from %s'
           % (len(artifacts), index_url))
     if not os.path.exists(folder):
         os.makedirs(folder)
-    with ThreadPoolExecutor(max_workers=max_workers) as e:
-        # Dispatch the file download in threads
-        futures = [e.submit(download, url_, filepath)
-                   for url_, filepath in artifacts]
-        for future in as_completed(futures):
-            # We don't expect any returned results be we want to raise
-            # an exception early in case if problem
-            future.result()
+    # The expected total grows as the downloads that are not skipped or
+    # served from the cache start
+    tracker = ProgressTracker(progress or ProgressListener())
+    try:
+        with span('download_files', n_files=len(artifacts)), \
+                ThreadPoolExecutor(max_workers=max_workers) as e:
+            # Dispatch the file download in threads
+            futures = [e.submit(download, url_, filepath,
+                                sha256=info.get('sha256'),
+                                size=info.get('size'), cache=cache,
+                                tracker=tracker)
+                       for url_, filepath, info in artifacts]
+            for future in as_completed(futures):
+                # We don't expect any returned results be we want to raise
+                # an exception early in case if problem
+                future.result()
+    finally:
+        tracker.close()
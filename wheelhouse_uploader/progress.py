@@ -0,0 +1,243 @@
+"""Progress reporting hooks for uploads and downloads
+
+Tools embedding the Uploader or download_artifacts can subclass
+ProgressListener and pass an instance as the ``progress`` parameter to be
+notified when each file transfer starts and finishes and, periodically, of
+the aggregate number of bytes transferred, the throughput and the estimated
+remaining time:
+
+    class MyListener(ProgressListener):
+
+        def on_progress(self, stats):
+            for name, idle in stats.idle_transfers(60).items():
+                print("%s has been stalled for %ds" % (name, idle))
+
+The transfer loops report each chunk to a ProgressTracker that aggregates
+the events and throttles the calls to ``on_progress``, so that listeners do
+not slow down the transfers.
+
+"""
+import threading
+from contextlib import contextmanager
+from time import time
+
+
+class TransferStats(object):
+    """Snapshot of the state of the transfers tracked by a ProgressTracker"""
+
+    def __init__(self, transferred, total, n_started, n_finished, n_failed,
+                 elapsed, active, now):
+        self.transferred = transferred
+        self.total = total
+        self.n_started = n_started
+        self.n_finished = n_finished
+        self.n_failed = n_failed
+        self.elapsed = elapsed
+        # name -> (transferred bytes, size or None, time of last progress)
+        self.active = active
+        self._now = now
+
+    @property
+    def rate(self):
+        """Average throughput in bytes per second"""
+        if self.elapsed <= 0:
+            return 0.
+        return self.transferred / self.elapsed
+
+    @property
+    def eta(self):
+        """Estimated remaining time in seconds, None if unknown"""
+        if self.total is None or self.rate <= 0:
+            return None
+        return max(self.total - self.transferred, 0) / self.rate
+
+    def idle_transfers(self, min_idle=0.):
+        """Active transfers without progress for at least min_idle seconds
+
+        Return a dict mapping the names of the transfers to the number of
+        seconds since their last progress.
+
+        """
+        idle = {}
+        for name, (_, _, last_update) in self.active.items():
+            idle_time = self._now - last_update
+            if idle_time >= min_idle:
+                idle[name] = idle_time
+        return idle
+
+
+class ProgressListener(object):
+    """Base class for progress event hooks: override the relevant methods"""
+
+    def on_start(self, name, size):
+        """A transfer has started, size is None if unknown"""
+
+    def on_progress(self, stats):
+        """Periodic TransferStats snapshot of the ongoing transfers"""
+
+    def on_finish(self, name, transferred, error=None):
+        """A transfer has completed, error is the exception if it failed"""
+
+    def on_close(self, stats):
+        """All the transfers have completed"""
+
+
+class ProgressTracker(object):
+    """Thread-safe aggregation of transfer events for a ProgressListener
+
+    Calls to ``on_progress`` are throttled to at most one every
+    ``min_interval`` seconds.
+
+    >>> class Printer(ProgressListener):
+    ...     def on_progress(self, stats):
+    ...         print('%d/%d bytes' % (stats.transferred, stats.total))
+    >>> tracker = ProgressTracker(Printer(), total=10, min_interval=0.)
+    >>> tracker.start('a.whl', 10)
+    >>> tracker.update('a.whl', 4)
+    4/10 bytes
+    >>> sorted(tracker.stats().idle_transfers())
+    ['a.whl']
+    >>> tracker.finish('a.whl')
+    >>> with tracker.transfer('b.whl', 6):
+    ...     chunks = list(tracker.track('b.whl', [b'abc', b'def']))
+    7/10 bytes
+    10/10 bytes
+    >>> tracker.stats().n_finished
+    2
+
+    A transfer started again from scratch does not count its bytes twice:
+
+    >>> tracker.start('c.whl')
+    >>> tracker.update('c.whl', 3)
+    13/10 bytes
+    >>> tracker.restart('c.whl')
+    >>> tracker.update('c.whl', 3)
+    13/10 bytes
+
+    """
+
+    def __init__(self, listener, total=None, min_interval=0.5):
+        self.listener = listener
+        self.total = total
+        self.min_interval = min_interval
+        self._lock = threading.Lock()
+        self._transferred = 0
+        self._n_started = 0
+        self._n_finished = 0
+        self._n_failed = 0
+        self._active = {}
+        self._start_time = None
+        self._last_emit = 0.
+
+    def expect(self, n_bytes):
+        """Add n_bytes to the expected total of the transfers"""
+        with self._lock:
+            self.total = (self.total or 0) + n_bytes
+
+    def _stats(self, now):
+        elapsed = 0. if self._start_time is None else now - self._start_time
+        return TransferStats(self._transferred, self.total, self._n_started,
+                             self._n_finished, self._n_failed, elapsed,
+                             dict(self._active), now)
+
+    def stats(self):
+        with self._lock:
+            return self._stats(time())
+
+    def start(self, name, size=None):
+        now = time()
+        with self._lock:
+            if self._start_time is None:
+                self._start_time = now
+            self._n_started += 1
+            self._active[name] = (0, size, now)
+        self.listener.on_start(name, size)
+
+    def update(self, name, n_bytes):
+        now = time()
+        with self._lock:
+            self._transferred += n_bytes
+            transferred, size, _ = self._active.get(name, (0, None, now))
+            self._active[name] = (transferred + n_bytes, size, now)
+            if now - self._last_emit < self.min_interval:
+                return
+            self._last_emit = now
+            stats = self._stats(now)
+        self.listener.on_progress(stats)
+
+    def restart(self, name):
+        """Discard the bytes already reported for a transfer started over"""
+        now = time()
+        with self._lock:
+            transferred, size, _ = self._active.get(name, (0, None, now))
+            self._transferred -= transferred
+            self._active[name] = (0, size, now)
+
+    def finish(self, name, error=None):
+        with self._lock:
+            transferred, _, _ = self._active.pop(name, (0, None, None))
+            self._n_finished += 1
+            if error is not None:
+                self._n_failed += 1
+        self.listener.on_finish(name, transferred, error=error)
+
+    def close(self):
+        self.listener.on_close(self.stats())
+
+    @contextmanager
+    def transfer(self, name, size=None):
+        """Report the start and the outcome of a transfer"""
+        self.start(name, size)
+        try:
+            yield
+        except Exception as e:
+            self.finish(name, error=e)
+            raise
+        self.finish(name)
+
+    def track(self, name, chunks):
+        """Report the chunks of an iterable as they are consumed"""
+        for chunk in chunks:
+            self.update(name, len(chunk))
+            yield chunk
+
+
+def _format_size(n_bytes):
+    return "%0.1f MB" % (n_bytes / 1e6)
+
+
+class ThroughputPrinter(ProgressListener):
+    """Print the aggregate throughput of the transfers
+
+    Used by the command line. Lines are printed at most every ``interval``
+    seconds.
+
+    """
+
+    def __init__(self, interval=5.):
+        self.interval = interval
+        self._last_print = time()
+
+    def on_progress(self, stats):
+        now = time()
+        if now - self._last_print < self.interval:
+            return
+        self._last_print = now
+        if stats.total is not None:
+            message = "%s / %s" % (_format_size(stats.transferred),
+                                   _format_size(stats.total))
+        else:
+            message = _format_size(stats.transferred)
+        message = "Transferred %s at %s/s (%d/%d files done)" % (
+            message, _format_size(stats.rate), stats.n_finished,
+            stats.n_started)
+        if stats.eta is not None:
+            message += ", ETA %ds" % stats.eta
+        print(message)
+
+    def on_close(self, stats):
+        if not stats.n_started:
+            return
+        print("Transferred %s in %0.1fs (%s/s)"
+              % (_format_size(stats.transferred), stats.elapsed,
+                 _format_size(stats.rate)))
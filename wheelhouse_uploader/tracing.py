@@ -0,0 +1,139 @@
+"""Timing spans of the upload and fetch phases
+
+When tracing is enabled (``--trace`` command line option), the code wrapped
+in ``span`` blocks is timed and the spans are written to a JSON file in the
+Chrome trace event format, which can be opened with chrome://tracing,
+https://ui.perfetto.dev or https://www.speedscope.app. Spans recorded in the
+same thread are displayed nested in each other.
+
+When tracing is disabled, ``span`` returns a shared no-op context manager.
+
+>>> import json, os, tempfile
+>>> tracer = start_tracing()
+>>> with span('upload', container='wheelhouse'):
+...     with span('scan') as scan:
+...         scan.set(n_files=3)
+>>> with span('tiny', min_duration=60):
+...     pass
+>>> trace_file = os.path.join(tempfile.mkdtemp(), 'trace.json')
+>>> _ = stop_tracing(trace_file)
+>>> with open(trace_file) as f:
+...     events = json.load(f)['traceEvents']
+>>> [(e['name'], e['args']) for e in events if e['ph'] == 'X']
+[('scan', {'n_files': 3}), ('upload', {'container': 'wheelhouse'})]
+>>> with span('ignored'):
+...     pass
+
+"""
+import json
+import os
+import threading
+from timeit import default_timer
+
+_tracer = None
+
+
+class Tracer(object):
+    """Thread-safe collection of timing spans"""
+
+    def __init__(self):
+        self.events = []
+        self._lock = threading.Lock()
+        self._origin = default_timer()
+        self._thread_names = {}
+
+    def add(self, name, start, end, args):
+        thread = threading.current_thread()
+        event = {
+            'name': name,
+            'cat': 'wheelhouse_uploader',
+            'ph': 'X',
+            # Timestamps and durations are expressed in microseconds
+            'ts': (start - self._origin) * 1e6,
+            'dur': (end - start) * 1e6,
+            'pid': os.getpid(),
+            'tid': thread.ident,
+            'args': args,
+        }
+        with self._lock:
+            self.events.append(event)
+            self._thread_names[thread.ident] = thread.name
+
+    def write(self, filepath):
+        with self._lock:
+            events = list(self.events)
+            thread_names = dict(self._thread_names)
+        for tid, name in sorted(thread_names.items()):
+            events.append({'name': 'thread_name', 'ph': 'M',
+                           'pid': os.getpid(), 'tid': tid,
+                           'args': {'name': name}})
+        with open(filepath, 'w') as f:
+            json.dump({'traceEvents': events, 'displayTimeUnit': 'ms'}, f)
+
+
+class _Span(object):
+
+    def __init__(self, tracer, name, min_duration, args):
+        self.tracer = tracer
+        self.name = name
+        self.min_duration = min_duration
+        self.args = args
+
+    def set(self, **args):
+        """Attach arguments known once the span has started"""
+        self.args.update(args)
+
+    def __enter__(self):
+        self.start = default_timer()
+        return self
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        end = default_timer()
+        if exc_type is not None:
+            self.args['error'] = exc_type.__name__
+        elif end - self.start < self.min_duration:
+            return
+        self.tracer.add(self.name, self.start, end, self.args)
+
+
+class _NullSpan(object):
+
+    def set(self, **args):
+        pass
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        pass
+
+
+_NULL_SPAN = _NullSpan()
+
+
+def span(name, min_duration=0., **args):
+    """Context manager timing a block of code when tracing is enabled
+
+    Spans shorter than min_duration seconds are not recorded unless they
+    raise an exception. The keyword arguments are stored with the span.
+
+    """
+    tracer = _tracer
+    if tracer is None:
+        return _NULL_SPAN
+    return _Span(tracer, name, min_duration, args)
+
+
+def start_tracing():
+    global _tracer
+    _tracer = Tracer()
+    return _tracer
+
+
+def stop_tracing(filepath=None):
+    """Stop recording spans and write them to filepath if provided"""
+    global _tracer
+    tracer, _tracer = _tracer, None
+    if tracer is not None and filepath is not None:
+        tracer.write(filepath)
+    return tracer
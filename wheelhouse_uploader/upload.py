@@ -1,32 +1,343 @@
-from __future__ import division
 import os
 import json
-from hashlib import sha256
-from time import sleep
+import re
+import threading
+from collections import Counter
+from hashlib import sha256, md5
+from time import sleep, time
 from io import StringIO
 from traceback import print_exc
 import tempfile
 import shutil
+from fnmatch import fnmatch
 from concurrent.futures import ThreadPoolExecutor, as_completed
+from queue import Queue
 
 from libcloud.common.types import InvalidCredsError
 from libcloud.storage.providers import get_driver
 from libcloud.storage.types import Provider
 from libcloud.storage.types import ContainerDoesNotExistError
 from libcloud.storage.types import ObjectDoesNotExistError
+from libcloud.storage.types import ObjectHashMismatchError
+
+from packaging.utils import canonicalize_name
+from packaging.version import InvalidVersion
 
 from wheelhouse_uploader.utils import matching_dev_filenames, stamp_dev_wheel
+from wheelhouse_uploader.utils import parse_filename, parse_version
+from wheelhouse_uploader.progress import ProgressListener, ProgressTracker
+from wheelhouse_uploader.tracing import span
+
+
+_md5_regex = re.compile(r'^[0-9a-f]{32}$')
+
+
+def _make_md5():
+    try:
+        return md5()
+    except ValueError:
+        # MD5 is blocked by the security policy (e.g. FIPS mode)
+        return None
+
+
+def _ensure_listed(filename, filenames):
+    """Lazily yield filenames and filename if it was missing from them
+
+    Eventual consistency listing might cause a just uploaded file to be
+    missing. Ensure this is never the case.
+
+    >>> list(_ensure_listed('b', iter(['a', 'c'])))
+    ['a', 'c', 'b']
+    >>> list(_ensure_listed('a', iter(['a', 'c'])))
+    ['a', 'c']
+
+    """
+    found = False
+    for name in filenames:
+        found = found or name == filename
+        yield name
+    if not found:
+        yield filename
+
+
+def _match_any(relpath, name, patterns):
+    return any(fnmatch(relpath, p) or fnmatch(name, p) for p in patterns)
+
+
+def _iter_local_files(folder, recursive=False, include=(), exclude=(),
+                      _prefix=''):
+    """Yield the DirEntry of the candidate files for upload in folder
+
+    Hidden files and folders are ignored. The include and exclude glob
+    patterns are matched against both the path relative to folder (with '/'
+    separators) and the name of each entry. Excluded folders are not
+    traversed.
+
+    The file type of the entries is read from the directory listing: files
+    filtered out by the patterns are never stat'ed.
+
+    >>> import tempfile
+    >>> folder = tempfile.mkdtemp()
+    >>> for relpath in ['a.whl', '.a.whl', 'notes.txt', 'build/b.whl',
+    ...                 'sub/c.whl', 'sub/deep/d.whl', '.git/e.whl']:
+    ...     filepath = os.path.join(folder, *relpath.split('/'))
+    ...     if not os.path.isdir(os.path.dirname(filepath)):
+    ...         os.makedirs(os.path.dirname(filepath))
+    ...     open(filepath, 'w').close()
+    >>> def relpaths(**kwargs):
+    ...     return [os.path.relpath(e.path, folder).replace(os.sep, '/')
+    ...             for e in _iter_local_files(folder, **kwargs)]
+    >>> relpaths()
+    ['a.whl', 'notes.txt']
+    >>> relpaths(recursive=True)
+    ['a.whl', 'build/b.whl', 'notes.txt', 'sub/c.whl', 'sub/deep/d.whl']
+    >>> relpaths(recursive=True, include=['*.whl'], exclude=['build'])
+    ['a.whl', 'sub/c.whl', 'sub/deep/d.whl']
+    >>> relpaths(recursive=True, include=['sub/*'], exclude=['sub/deep'])
+    ['sub/c.whl']
+
+    """
+    for entry in sorted(os.scandir(folder), key=lambda e: e.name):
+        if entry.name.startswith('.'):
+            continue
+        relpath = _prefix + entry.name
+        if _match_any(relpath, entry.name, exclude):
+            continue
+        if entry.is_dir(follow_symlinks=False):
+            if recursive:
+                for sub_entry in _iter_local_files(
+                        entry.path, recursive=True, include=include,
+                        exclude=exclude, _prefix=relpath + '/'):
+                    yield sub_entry
+            continue
+        if include and not _match_any(relpath, entry.name, include):
+            continue
+        if entry.is_file():
+            yield entry
+
+
+def _labeled(message, label=None):
+    """Prefix message with the label of its destination, if any"""
+    if label is None:
+        return message
+    return "%s: %s" % (label, message)
+
+
+def _json_file_entry(filename, object_metadata):
+    entry = {
+        'filename': filename,
+        'url': filename,
+        'hashes': dict((name, object_metadata[name])
+                       for name in ('sha256', 'md5')
+                       if name in object_metadata),
+    }
+    if 'size' in object_metadata:
+        entry['size'] = object_metadata['size']
+    return entry
+
+
+def _version_sort_key(version):
+    try:
+        return (1, parse_version(version))
+    except InvalidVersion:
+        # Sort non PEP 440 versions first
+        return (0, version)
+
+
+def _json_index(container_name, files):
+    """Build a PEP 691 JSON project page from the file entries
+
+    The files sizes and the list of versions of PEP 700 are included: the
+    page advertises version 1.1 of the API if the size of all the files is
+    known.
+
+    >>> index = _json_index('wheelhouse', [
+    ...     {'filename': 'Proj-1.0.tar.gz', 'url': 'Proj-1.0.tar.gz',
+    ...      'hashes': {}, 'size': 10},
+    ...     {'filename': 'Proj-1.1-py3-none-any.whl',
+    ...      'url': 'Proj-1.1-py3-none-any.whl', 'hashes': {}, 'size': 12},
+    ... ])
+    >>> index['meta'], index['name'], index['versions']
+    ({'api-version': '1.1'}, 'proj', ['1.0', '1.1'])
+
+    """
+    names = set()
+    versions = set()
+    for entry in files:
+        try:
+            distname, version, _, _ = parse_filename(entry['filename'])
+        except ValueError:
+            continue
+        names.add(canonicalize_name(distname))
+        versions.add(version)
+    if len(names) == 1:
+        name = names.pop()
+    else:
+        # Not a single project wheelhouse
+        name = canonicalize_name(container_name)
+    all_sizes = all('size' in entry for entry in files)
+    return {
+        'meta': {'api-version': '1.1' if all_sizes else '1.0'},
+        'name': name,
+        'versions': sorted(versions, key=_version_sort_key),
+        'files': files,
+    }
+
+
+def _make_tracker(listener, filepaths):
+    """ProgressTracker expecting the total size of filepaths"""
+    total = 0
+    for filepath in filepaths:
+        try:
+            total += os.path.getsize(filepath)
+        except OSError:
+            # Reported by the upload itself
+            pass
+    return ProgressTracker(listener, total=total)
+
+
+class HashingReader(object):
+    """Iterate over the chunks of a file object while hashing them
+
+    The digests and size of the content are available once the iteration is
+    complete, which makes it possible to compute the metadata of a file in
+    the same pass as its upload.
+
+    The MD5 digest is not used for security purposes but to check the
+    integrity of the uploaded object against the checksum (typically the
+    ETag) returned by the storage provider.
+
+    >>> from io import BytesIO
+    >>> reader = HashingReader(BytesIO(b'some content'), chunk_size=5)
+    >>> list(reader)
+    [b'some ', b'conte', b'nt']
+    >>> metadata = reader.metadata()
+    >>> metadata['size']
+    12
+    >>> metadata['sha256']                                # doctest: +ELLIPSIS
+    '290f49...'
+    >>> metadata['md5']
+    '9893532233caff98cd083a116b013c0b'
+
+    """
+
+    def __init__(self, fileobj, chunk_size=int(1e6)):
+        self.fileobj = fileobj
+        self.chunk_size = chunk_size
+        self.sha256 = sha256()
+        self.md5 = _make_md5()
+        self.size = 0
+
+    def __iter__(self):
+        data = self.fileobj.read(self.chunk_size)
+        while data:
+            with span('hash', size=len(data)):
+                self.sha256.update(data)
+                if self.md5 is not None:
+                    self.md5.update(data)
+            self.size += len(data)
+            yield data
+            data = self.fileobj.read(self.chunk_size)
+
+    def hexdigest(self, hash_name):
+        """Digest of the content read so far, None if not computed"""
+        if hash_name == 'sha256':
+            return self.sha256.hexdigest()
+        if hash_name == 'md5' and self.md5 is not None:
+            return self.md5.hexdigest()
+        return None
+
+    def metadata(self):
+        metadata = dict(
+            sha256=self.sha256.hexdigest(),
+            size=self.size,
+        )
+        if self.md5 is not None:
+            metadata['md5'] = self.md5.hexdigest()
+        return metadata
+
+
+class _UploadStream(object):
+    """Iterator over the chunks of a file streamed to a storage driver
+
+    Gives access to the HashingReader that computes the digests of the
+    content (see _patch_stream_hashing).
+
+    """
+
+    def __init__(self, chunks, reader):
+        self._chunks = iter(chunks)
+        self.reader = reader
+
+    def __iter__(self):
+        return self
+
+    def __next__(self):
+        return next(self._chunks)
+
+
+def _patch_stream_hashing(driver):
+    """Make driver use the digests computed while streaming an upload
+
+    libcloud 2.2.1 hashes a streamed upload by exhausting the stream after
+    the HTTP request has consumed it: the digest is always the one of an
+    empty payload. Drivers that check it against the ETag returned by the
+    server, such as CloudFiles, then reject every streamed upload. The
+    patched driver uses the digest computed by the HashingReader of
+    _UploadStream instances instead.
+
+    >>> from io import BytesIO
+    >>> from wheelhouse_uploader.fake_storage import FakeCloudFilesStore
+    >>> from wheelhouse_uploader.fake_storage import FakeCloudFilesDriver
+    >>> def upload(driver):
+    ...     reader = HashingReader(BytesIO(b'some content'), chunk_size=5)
+    ...     container = driver.get_container('wheelhouse')
+    ...     return driver.upload_object_via_stream(
+    ...         _UploadStream(reader, reader), container, 'a.whl')
+    >>> try:
+    ...     upload(FakeCloudFilesDriver(FakeCloudFilesStore()))
+    ... except ObjectHashMismatchError as e:
+    ...     # digest of an empty payload
+    ...     print('expected=d41d8cd98f00b204e9800998ecf8427e' in e.value)
+    True
+    >>> driver = _patch_stream_hashing(
+    ...     FakeCloudFilesDriver(FakeCloudFilesStore()))
+    >>> upload(driver).hash
+    '9893532233caff98cd083a116b013c0b'
+
+    """
+    hash_buffered_stream = driver._hash_buffered_stream
+
+    def _hash_buffered_stream(stream, hasher, *args, **kwargs):
+        if isinstance(stream, _UploadStream):
+            digest = stream.reader.hexdigest(hasher.name)
+            if digest is not None:
+                return digest, stream.reader.size
+        return hash_buffered_stream(stream, hasher, *args, **kwargs)
+
+    # Drivers are created for each upload task: patching the instance does
+    # not affect other threads
+    driver._hash_buffered_stream = _hash_buffered_stream
+    return driver
 
 
 class Uploader(object):
 
     index_filename = "index.html"
 
+    json_index_filename = "index.json"
+
     metadata_filename = 'metadata.json'
 
+    # Providers whose object hash is not a digest of the content
+    # (the LOCAL driver hashes the file modification time)
+    unverifiable_providers = ('LOCAL',)
+
     def __init__(self, username, secret, provider_name, region,
                  update_index=True, max_workers=4,
-                 delete_previous_dev_packages=True):
+                 delete_previous_dev_packages=True, chunk_size=int(1e6),
+                 max_verify_attempts=3, recursive=False, include=(),
+                 exclude=(), progress=None):
         self.username = username
         self.secret = secret
         self.provider_name = provider_name
@@ -34,8 +345,25 @@ class Uploader(object):
         self.max_workers = max_workers
         self.update_index = update_index
         self.delete_previous_dev_packages = delete_previous_dev_packages
+        self.chunk_size = chunk_size
+        self.max_verify_attempts = max_verify_attempts
+        self.recursive = recursive
+        self.include = include
+        self.exclude = exclude
+        self._verification_stats = Counter()
+        self._verification_lock = threading.Lock()
+        # ProgressListener notified of the progress of the uploads
+        if progress is None:
+            progress = ProgressListener()
+        self.progress = progress
+        self._tracker = ProgressTracker(self.progress)
 
     def make_driver(self):
+        with span('make_driver', provider=self.provider_name):
+            driver = self._create_driver()
+        return _patch_stream_hashing(driver)
+
+    def _create_driver(self):
         provider = getattr(Provider, self.provider_name)
         return get_driver(provider)(self.username, self.secret,
                                     region=self.region)
@@ -56,205 +384,650 @@ class Uploader(object):
             self.upload(local_folder, container,
                         retry_on_error=retry_on_error - 1)
 
+    def _get_or_create_container(self, container_name):
+        driver = self.make_driver()
+        with span('get_container', container=container_name):
+            try:
+                container = driver.get_container(container_name)
+            except ContainerDoesNotExistError:
+                container = driver.create_container(container_name)
+            except InvalidCredsError:
+                # Tell which destination failed when uploading to several
+                raise InvalidCredsError(
+                    value="user '%s' on %s:%s" % (
+                        self.username, self.provider_name, container_name),
+                    driver=driver)
+        return driver, container
+
     def _try_upload_once(self, local_folder, container_name):
         # check that the container is reachable
-        driver = self.make_driver()
-        try:
-            container = driver.get_container(container_name)
-        except ContainerDoesNotExistError:
-            container = driver.create_container(container_name)
+        driver, container = self._get_or_create_container(container_name)
 
-        filepaths, local_metadata = self._scan_local_files(local_folder)
+        filepaths = self._scan_local_files(local_folder)
 
-        self._upload_files(filepaths, container_name)
+        # The metadata of the uploaded files is computed while streaming
+        # their content to the container
+        local_metadata = self._upload_files(filepaths, container_name)
         recently_uploaded = [os.path.basename(path) for path in filepaths]
+        self._refresh_container(driver, container, local_metadata,
+                                recently_uploaded=recently_uploaded)
 
+    def _refresh_container(self, driver, container, local_metadata,
+                           recently_uploaded=(), label=None):
         # Refresh metadata
-        metadata = self._update_metadata_file(
-            driver, container, local_metadata,
-            recently_uploaded=recently_uploaded)
+        with span('update_metadata', container=container.name):
+            metadata = self._update_metadata_file(
+                driver, container, local_metadata,
+                recently_uploaded=recently_uploaded, label=label)
         if self.update_index:
-            self._update_index(driver, container, metadata,
-                               recently_uploaded=recently_uploaded)
+            with span('update_index', container=container.name):
+                self._update_index(driver, container, metadata,
+                                   recently_uploaded=recently_uploaded,
+                                   label=label)
+
+    def watch(self, local_folder, container_name, poll_interval=2.,
+              debounce=10., idle_timeout=None, max_attempts=3):
+        """Upload files as soon as they are written in the local folder
+
+        A file is considered complete once its size and modification time
+        have not changed between two consecutive polls of the folder. Files
+        deleted or renamed before that are ignored. The local folder does not
+        need to exist yet.
+
+        The metadata and index files are not refreshed after each upload:
+        the refresh is delayed until no upload has completed for ``debounce``
+        seconds so that a burst of new files triggers a single index rebuild.
+
+        Watching stops after ``idle_timeout`` seconds without any new file
+        (never if None) or on KeyboardInterrupt. Pending metadata and index
+        updates are flushed before returning.
+
+        A failed refresh keeps the pending metadata and is tried again after
+        another ``debounce`` delay. Watching stops with the error after
+        ``max_attempts`` consecutive failed refreshes.
+
+        >>> import tempfile
+        >>> from wheelhouse_uploader.fake_storage import (
+        ...     FakeCloudFilesStore, FakeCloudFilesUploader)
+        >>> folder = tempfile.mkdtemp()
+        >>> with open(os.path.join(folder, 'proj-1.0-py3-none-any.whl'),
+        ...           'wb') as f:
+        ...     _ = f.write(b'content')
+        >>> store = FakeCloudFilesStore()
+        >>> store.fail['metadata.json'] = 1
+        >>> FakeCloudFilesUploader(store).watch(
+        ...     folder, 'wh', poll_interval=0., debounce=0., idle_timeout=0.)
+        ...                                               # doctest: +ELLIPSIS
+        Watching ... for new files to upload to wh
+        Uploading .../proj-1.0-py3-none-any.whl [0.000 MB]
+        Verified 1/1 uploaded files against the checksums returned by the provider
+        Uploading metadata.json with 1 entries
+        Failed to refresh the index of wh: LibcloudError ...
+        Uploading metadata.json with 1 entries
+        Updating index.html with 1 links
+        Updating index.json with 1 files
+        No new file in ... for 0.0s: stop watching
+        >>> sorted(json.loads(store.objects[('wh', 'metadata.json')]
+        ...                   .decode('utf-8')))
+        ['proj-1.0-py3-none-any.whl']
+
+        A temporary file renamed once written is uploaded under its final
+        name only, and does not prevent the watch from timing out:
+
+        >>> tmp_path = os.path.join(folder, 'proj-1.1-py3-none-any.whl.tmp')
+        >>> with open(tmp_path, 'wb') as f:
+        ...     _ = f.write(b'new content')
+        >>> class RenamingUploader(FakeCloudFilesUploader):
+        ...     polls = 0
+        ...     def _iter_local_files(self, local_folder):
+        ...         self.polls += 1
+        ...         if self.polls == 2:
+        ...             os.rename(tmp_path, tmp_path[:-len('.tmp')])
+        ...         return FakeCloudFilesUploader._iter_local_files(
+        ...             self, local_folder)
+        >>> store = FakeCloudFilesStore()
+        >>> RenamingUploader(store).watch(
+        ...     folder, 'wh', poll_interval=0., debounce=0., idle_timeout=0.)
+        ...                                               # doctest: +ELLIPSIS
+        Watching ... for new files to upload to wh
+        Uploading .../proj-1.0-py3-none-any.whl [0.000 MB]
+        Uploading .../proj-1.1-py3-none-any.whl [0.000 MB]
+        Verified 2/2 uploaded files against the checksums returned by the provider
+        Uploading metadata.json with 2 entries
+        Updating index.html with 2 links
+        Updating index.json with 2 files
+        No new file in ... for 0.0s: stop watching
+
+        A missing folder is watched as an empty folder:
+
+        >>> FakeCloudFilesUploader(store).watch(
+        ...     os.path.join(folder, 'dist'), 'wh', poll_interval=0.,
+        ...     idle_timeout=0.)                          # doctest: +ELLIPSIS
+        Watching .../dist for new files to upload to wh
+        No new file in .../dist for 0.0s: stop watching
+
+        """
+        destination = self._get_or_create_container(container_name)
+        print("Watching %s for new files to upload to %s"
+              % (local_folder, container_name))
+        self._tracker = ProgressTracker(self.progress)
+        candidates = {}  # filepath -> (size, mtime) observed at last poll
+        done = set()  # filepaths uploaded or skipped
+        object_paths = {}  # object name -> filepath
+        attempts = {}
+        in_flight = {}  # future -> filepath
+        local_metadata = {}  # uploaded since the last index refresh
+        refresh_failures = 0
+        last_upload = last_activity = time()
+
+        executor = ThreadPoolExecutor(max_workers=self.max_workers)
+        try:
+            while True:
+                if os.path.isdir(local_folder):
+                    entries = self._iter_local_files(local_folder)
+                else:
+                    # Not created yet, e.g. by the first build
+                    entries = ()
+                seen = set()
+                for entry in entries:
+                    filepath = entry.path
+                    if filepath in done:
+                        continue
+                    try:
+                        stat = entry.stat()
+                    except OSError:
+                        # File deleted or renamed since the listing
+                        continue
+                    seen.add(filepath)
+                    state = (stat.st_size, stat.st_mtime)
+                    if candidates.get(filepath) != state:
+                        # New or still being written: check again at the
+                        # next poll
+                        candidates[filepath] = state
+                        last_activity = time()
+                        continue
+                    del candidates[filepath]
+                    done.add(filepath)
+                    filepath = self._prepare_local_file(filepath)
+                    if filepath is None:
+                        continue
+                    done.add(filepath)
+                    filename = os.path.basename(filepath)
+                    if object_paths.setdefault(filename, filepath) != filepath:
+                        print("Skipping %s: %s was already uploaded from %s"
+                              % (filepath, filename, object_paths[filename]))
+                        continue
+                    self._tracker.expect(state[0])
+                    future = executor.submit(self.upload_file, filepath,
+                                             container_name)
+                    in_flight[future] = filepath
+
+                # Forget the files deleted or renamed before they were
+                # complete, e.g. temporary files
+                for filepath in set(candidates) - seen:
+                    del candidates[filepath]
+
+                for future in [f for f in in_flight if f.done()]:
+                    filepath = in_flight.pop(future)
+                    filename = os.path.basename(filepath)
+                    last_upload = last_activity = time()
+                    try:
+                        local_metadata[filename] = future.result()
+                    except Exception as e:
+                        attempts[filepath] = attempts.get(filepath, 0) + 1
+                        print("Failed to upload %s: %s %s"
+                              % (filepath, type(e).__name__, e))
+                        if attempts[filepath] < max_attempts:
+                            # Try again at the next poll
+                            done.discard(filepath)
+                        continue
+
+                now = time()
+                if (local_metadata and not in_flight
+                        and now - last_upload >= debounce):
+                    self._report_verification()
+                    destination = self._flush_refresh(
+                        container_name, destination, local_metadata,
+                        last_attempt=refresh_failures + 1 >= max_attempts)
+                    if destination is None:
+                        # Keep the pending metadata and try again after
+                        # another debounce delay
+                        refresh_failures += 1
+                        last_upload = now
+                    else:
+                        refresh_failures = 0
+                        local_metadata = {}
+
+                if (idle_timeout is not None and not in_flight
+                        and not candidates and not local_metadata
+                        and now - last_activity >= idle_timeout):
+                    print("No new file in %s for %0.1fs: stop watching"
+                          % (local_folder, idle_timeout))
+                    break
+                sleep(poll_interval)
+        except KeyboardInterrupt:
+            print("Interrupted: waiting for %d pending uploads"
+                  % len(in_flight))
+            for future, filepath in in_flight.items():
+                filename = os.path.basename(filepath)
+                try:
+                    local_metadata[filename] = future.result()
+                except Exception as e:
+                    print("Failed to upload %s: %s %s"
+                          % (filepath, type(e).__name__, e))
+            if local_metadata:
+                self._report_verification()
+            while local_metadata:
+                destination = self._flush_refresh(
+                    container_name, destination, local_metadata,
+                    last_attempt=refresh_failures + 1 >= max_attempts)
+                if destination is None:
+                    refresh_failures += 1
+                    sleep(1)
+                else:
+                    local_metadata = {}
+        finally:
+            executor.shutdown(wait=True)
+            self._tracker.close()
+
+    def _flush_refresh(self, container_name, destination, local_metadata,
+                       last_attempt=False):
+        """Refresh the metadata and index files of a watched container
+
+        destination is the (driver, container) pair used for the previous
+        refresh, None to connect again. Return the pair to use for the next
+        refresh, or None if the refresh failed. Unless last_attempt is True,
+        errors are printed instead of raised so that the caller can keep the
+        pending metadata and try again.
+
+        """
+        try:
+            if destination is None:
+                destination = self._get_or_create_container(container_name)
+            driver, container = destination
+            self._refresh_container(driver, container, local_metadata,
+                                    recently_uploaded=list(local_metadata))
+        except InvalidCredsError:
+            raise
+        except Exception as e:
+            if last_attempt:
+                raise
+            # can be caused by any network or server side failure: connect
+            # again for the next attempt
+            print("Failed to refresh the index of %s: %s %s"
+                  % (container_name, type(e).__name__, e))
+            print_exc()
+            return None
+        return destination
 
     def _upload_files(self, filepaths, container_name):
         print("About to upload %d files" % len(filepaths))
-        with ThreadPoolExecutor(max_workers=self.max_workers) as e:
-            # Dispatch the file uploads in threads
-            futures = [e.submit(self.upload_file, filepath_, container_name)
-                       for filepath_ in filepaths]
-            for future in as_completed(futures):
-                # We don't expect any returned results be we want to raise
-                # an exception early in case if problem
-                future.result()
-
-    def _upload_bytes(self, payload, container, object_name):
-        tempdir = tempfile.mkdtemp()
-        tempfilepath = os.path.join(
-            tempdir, '_tmp_wheelhouse_uploader_upload_' + object_name)
+        local_metadata = {}
+        self._tracker = _make_tracker(self.progress, filepaths)
         try:
-            with open(tempfilepath, 'wb') as f:
-                f.write(payload)
-            container.upload_object(file_path=tempfilepath,
-                                    object_name=object_name)
+            with span('upload_files', n_files=len(filepaths)), \
+                    ThreadPoolExecutor(max_workers=self.max_workers) as e:
+                # Dispatch the file uploads in threads
+                futures = dict(
+                    (e.submit(self.upload_file, filepath_, container_name),
+                     os.path.basename(filepath_))
+                    for filepath_ in filepaths)
+                for future in as_completed(futures):
+                    # Raise an exception early in case of problem
+                    local_metadata[futures[future]] = future.result()
         finally:
+            self._tracker.close()
+        self._report_verification()
+        return local_metadata
+
+    def _record_verification(self, outcome):
+        with self._verification_lock:
+            self._verification_stats[outcome] += 1
+
+    def _report_verification(self, label=None):
+        with self._verification_lock:
+            stats = self._verification_stats
+            self._verification_stats = Counter()
+        total = stats['verified'] + stats['unverified']
+        if not total:
+            return
+        message = ("Verified %d/%d uploaded files against the checksums "
+                   "returned by the provider" % (stats['verified'], total))
+        if stats['reuploaded']:
+            message += " (%d re-uploaded)" % stats['reuploaded']
+        print(_labeled(message, label))
+
+    def _remote_md5(self, obj):
+        """MD5 digest of an uploaded object as reported by the provider
+
+        Return None if the provider does not return a usable content digest,
+        e.g. for multipart upload ETags.
+
+        """
+        if self.provider_name in self.unverifiable_providers:
+            return None
+        etag = getattr(obj, 'hash', None) or obj.extra.get('etag')
+        if not etag:
+            return None
+        etag = etag.strip('"').lower()
+        if _md5_regex.match(etag) is None:
+            return None
+        return etag
+
+    def _upload_bytes(self, payload, container, object_name):
+        with span('upload_object', object=object_name, size=len(payload)):
+            tempdir = tempfile.mkdtemp()
+            tempfilepath = os.path.join(
+                tempdir, '_tmp_wheelhouse_uploader_upload_' + object_name)
             try:
-                shutil.rmtree(tempdir)
-            except OSError:
-                # Ignore permission errors on temporary directories
-                print("WARNING: failed to delete", tempdir)
+                with open(tempfilepath, 'wb') as f:
+                    f.write(payload)
+                container.upload_object(file_path=tempfilepath,
+                                        object_name=object_name)
+            finally:
+                try:
+                    shutil.rmtree(tempdir)
+                except OSError:
+                    # Ignore permission errors on temporary directories
+                    print("WARNING: failed to delete", tempdir)
 
     def _download_bytes(self, container, object_name, missing=None):
-        tempdir = tempfile.mkdtemp()
-        tempfilepath = os.path.join(
-            tempdir, '_tmp_wheelhouse_uploader_download_' + object_name)
-        try:
-            container.get_object(object_name).download(tempfilepath)
-            with open(tempfilepath, 'rb') as f:
-                return f.read()
-        except ObjectDoesNotExistError:
-            return missing
-        finally:
+        with span('download_object', object=object_name):
+            tempdir = tempfile.mkdtemp()
+            tempfilepath = os.path.join(
+                tempdir, '_tmp_wheelhouse_uploader_download_' + object_name)
             try:
-                shutil.rmtree(tempdir)
-            except OSError:
-                # Ignore permission errors on temporary directories
-                print("WARNING: faile to delete", tempdir)
+                container.get_object(object_name).download(tempfilepath)
+                with open(tempfilepath, 'rb') as f:
+                    return f.read()
+            except ObjectDoesNotExistError:
+                return missing
+            finally:
+                try:
+                    shutil.rmtree(tempdir)
+                except OSError:
+                    # Ignore permission errors on temporary directories
+                    print("WARNING: faile to delete", tempdir)
 
     def _update_metadata_file(self, driver, container, local_metadata,
-                              recently_uploaded=()):
+                              recently_uploaded=(), label=None):
         data = self._download_bytes(container, self.metadata_filename)
         if data is None:
             metadata = {}
         else:
             metadata = json.loads(data.decode('utf-8'))
-        metadata.update(local_metadata)
 
-        # Garbage collect metadata for deleted files
-        filenames = set(self._get_package_filenames(driver, container))
+        with span('merge_metadata') as merge_span:
+            metadata.update(local_metadata)
 
-        # Make sure that the recently uploaded files are included: the
-        # eventual consistency semantics of the container listing might hidden
-        # them temporarily.
-        filenames.union(recently_uploaded)
+            # Garbage collect metadata for deleted files. The listing is
+            # consumed lazily and only the names that have metadata are kept.
+            # Make sure that the recently uploaded files are included: the
+            # eventual consistency semantics of the container listing might
+            # hidden them temporarily.
+            filenames = set(recently_uploaded)
+            for filename in self._iter_package_filenames(driver, container):
+                if filename in metadata:
+                    filenames.add(filename)
 
-        keys = list(sorted(metadata.keys()))
-        for key in keys:
-            if key not in filenames:
-                del metadata[key]
+            keys = list(sorted(metadata.keys()))
+            for key in keys:
+                if key not in filenames:
+                    del metadata[key]
+            merge_span.set(n_entries=len(metadata))
 
-        print('Uploading %s with %d entries'
-              % (self.metadata_filename, len(metadata)))
+        print(_labeled('Uploading %s with %d entries'
+                       % (self.metadata_filename, len(metadata)), label))
 
         self._upload_bytes(json.dumps(metadata).encode('utf-8'),
                            container, self.metadata_filename)
         return metadata
 
-    def _get_package_filenames(self, driver, container,
-                               ignore_list=('.json', '.html')):
-        package_filenames = []
-        objects = driver.list_container_objects(container)
-        for object_ in objects:
-            if not object_.name.endswith(ignore_list):
-                package_filenames.append(object_.name)
-        return package_filenames
+    def _iter_package_filenames(self, driver, container,
+                                ignore_list=('.json', '.html'), prefix=None):
+        """Lazily iterate over the names of the packages in the container
 
-    def _update_index(self, driver, container, metadata, recently_uploaded=()):
-        # TODO use a mako template instead
-        package_filenames = self._get_package_filenames(driver, container)
+        Listing pages are fetched as the iteration progresses so that the
+        object records of huge containers are never all held in memory.
 
+        """
+        try:
+            objects = driver.iterate_container_objects(container,
+                                                       ex_prefix=prefix)
+        except TypeError:
+            # This driver does not support server side prefix filtering
+            objects = driver.iterate_container_objects(container)
+        objects = iter(objects)
+        while True:
+            # Only the calls waiting for a listing page are long enough to be
+            # recorded
+            with span('list_objects', min_duration=1e-3,
+                      container=container.name):
+                object_ = next(objects, None)
+            if object_ is None:
+                return
+            name = object_.name
+            if prefix is not None and not name.startswith(prefix):
+                continue
+            if not name.endswith(ignore_list):
+                yield name
+
+    def _update_index(self, driver, container, metadata, recently_uploaded=(),
+                      label=None):
+        # TODO use a mako template instead
         # Make sure that the recently uploaded files are included: the
         # eventual consistency semantics of the container listing might hidden
         # them temporarily.
-        package_filenames = set(package_filenames).union(recently_uploaded)
-        package_filenames = sorted(package_filenames)
+        missing = set(recently_uploaded)
+
+        def package_filenames():
+            # Links are written as the listing pages arrive
+            for filename in self._iter_package_filenames(driver, container):
+                missing.discard(filename)
+                yield filename
+            for filename in sorted(missing):
+                yield filename
 
-        print('Updating index.html with %d links' % len(package_filenames))
         payload = StringIO()
         payload.write(u'<html><body><p>\n')
-        for filename in package_filenames:
-            object_metadata = metadata.get(filename, {})
-            digest = object_metadata.get('sha256')
-            if digest is not None:
-                payload.write(
-                    u'<li><a href="%s#sha256=%s">%s</a></li>\n'
-                    % (filename, digest, filename))
-            else:
-                payload.write(u'<li><a href="%s">%s</a></li>\n'
-                              % (filename, filename))
+        n_links = 0
+        json_files = []
+        # The listing pages are fetched while rendering the index
+        with span('render_index') as render_span:
+            for filename in package_filenames():
+                n_links += 1
+                object_metadata = metadata.get(filename, {})
+                json_files.append(_json_file_entry(filename, object_metadata))
+                digest = object_metadata.get('sha256')
+                if digest is not None:
+                    payload.write(
+                        u'<li><a href="%s#sha256=%s">%s</a></li>\n'
+                        % (filename, digest, filename))
+                else:
+                    payload.write(u'<li><a href="%s">%s</a></li>\n'
+                                  % (filename, filename))
+            render_span.set(n_links=n_links)
         payload.write(u'</p></body></html>\n')
         payload.seek(0)
+        print(_labeled('Updating index.html with %d links' % n_links, label))
         self._upload_bytes(payload.getvalue().encode('utf-8'),
                            container, self.index_filename)
 
+        json_index = _json_index(container.name, json_files)
+        print(_labeled('Updating %s with %d files'
+                       % (self.json_index_filename, len(json_files)), label))
+        self._upload_bytes(json.dumps(json_index).encode('utf-8'),
+                           container, self.json_index_filename)
+
     def _scan_local_files(self, local_folder):
-        """Collect file informations on the folder to upload.
+        """Collect the paths of the files to upload.
 
         Dev wheel files will automatically get renamed to add an upload time
         stamp in the process.
 
+        The files are not read at this stage: their digests are computed
+        while uploading them. As the container is flat, only the first of
+        the files sharing the same name is uploaded:
+
+        >>> import tempfile
+        >>> folder = tempfile.mkdtemp()
+        >>> for relpath in ['a/proj-1.0-py3-none-any.whl',
+        ...                 'b/proj-1.0-py3-none-any.whl',
+        ...                 'b/proj-1.1-py3-none-any.whl']:
+        ...     filepath = os.path.join(folder, *relpath.split('/'))
+        ...     if not os.path.isdir(os.path.dirname(filepath)):
+        ...         os.makedirs(os.path.dirname(filepath))
+        ...     open(filepath, 'w').close()
+        >>> uploader = Uploader('user', 'secret', 'CLOUDFILES', 'ord',
+        ...                     recursive=True)
+        >>> filepaths = uploader._scan_local_files(folder)
+        ...                         # doctest: +ELLIPSIS +NORMALIZE_WHITESPACE
+        Skipping .../b/proj-1.0-py3-none-any.whl: proj-1.0-py3-none-any.whl
+        is already uploaded from .../a/proj-1.0-py3-none-any.whl
+        >>> [os.path.relpath(p, folder).replace(os.sep, '/')
+        ...  for p in filepaths]
+        ['a/proj-1.0-py3-none-any.whl', 'b/proj-1.1-py3-none-any.whl']
+
         """
         filepaths = []
-        local_metadata = {}
+        object_paths = {}
 
-        for filename in sorted(os.listdir(local_folder)):
-            if filename.startswith('.'):
-                continue
-            filepath = os.path.join(local_folder, filename)
-            if os.path.isdir(filepath):
-                continue
+        with span('scan', folder=local_folder) as scan_span:
+            for entry in self._iter_local_files(local_folder):
+                filepath = self._prepare_local_file(entry.path)
+                if filepath is None:
+                    continue
+                # The container is flat: files are uploaded under their name
+                filename = os.path.basename(filepath)
+                if filename in object_paths:
+                    print("Skipping %s: %s is already uploaded from %s"
+                          % (filepath, filename, object_paths[filename]))
+                    continue
+                object_paths[filename] = filepath
+                filepaths.append(filepath)
+            scan_span.set(n_files=len(filepaths))
+        return filepaths
 
-            try:
-                should_rename, new_filename = stamp_dev_wheel(filename)
-                new_filepath = os.path.join(local_folder, new_filename)
-                if should_rename:
-                    print("Renaming dev wheel to add an upload timestamp: %s"
-                          % new_filename)
-                    os.rename(filepath, new_filepath)
-                    filepath, filename = new_filepath, new_filename
-            except ValueError as e:
-                print("Skipping %s: %s" % (filename, e))
-                continue
-            # TODO: use a threadpool
-            filepaths.append(filepath)
-            with open(filepath, 'rb') as f:
-                content = f.read()
-            local_metadata[filename] = dict(
-                sha256=sha256(content).hexdigest(),
-                size=len(content),
-            )
-        return filepaths, local_metadata
-
-    def upload_file(self, filepath, container_name):
-        # drivers are not thread safe, hence we create one per upload task
-        # to make it possible to use a thread pool executor
-        driver = self.make_driver()
+    def _iter_local_files(self, local_folder):
+        return _iter_local_files(local_folder, recursive=self.recursive,
+                                 include=self.include, exclude=self.exclude)
+
+    def _prepare_local_file(self, filepath):
+        """Stamp dev wheels and return the path of the file to upload
+
+        Return None if the file should not be uploaded.
+
+        """
+        folder, filename = os.path.split(filepath)
+        try:
+            should_rename, new_filename = stamp_dev_wheel(filename)
+            new_filepath = os.path.join(folder, new_filename)
+            if should_rename:
+                print("Renaming dev wheel to add an upload timestamp: %s"
+                      % new_filename)
+                os.rename(filepath, new_filepath)
+                filepath = new_filepath
+        except ValueError as e:
+            print("Skipping %s: %s" % (filename, e))
+            return None
+        return filepath
+
+    def upload_file(self, filepath, container_name, tracker=None):
+        """Upload a file and return its metadata (sha256 digest and size)
+
+        The file is read only once: the digest is computed on the chunks
+        streamed to the storage driver.
+
+        The progress of the upload is reported to tracker (a ProgressTracker)
+        if provided, to the tracker of the current batch otherwise.
+
+        """
+        if tracker is None:
+            tracker = self._tracker
         filename = os.path.basename(filepath)
-        container = driver.get_container(container_name)
+        with span('upload_file', file=filepath):
+            # drivers are not thread safe, hence we create one per upload task
+            # to make it possible to use a thread pool executor
+            driver = self.make_driver()
+            with span('get_container', container=container_name):
+                container = driver.get_container(container_name)
 
-        size_mb = os.stat(filepath).st_size / 1e6
-        print("Uploading %s [%0.3f MB]" % (filepath, size_mb))
-        driver.upload_object(file_path=filepath,
-                             container=container,
-                             object_name=filename)
-
-        if self.delete_previous_dev_packages:
-            existing_filenames = self._get_package_filenames(driver, container)
-            if filename not in existing_filenames:
-                # Eventual consistency listing might cause the just uploaded
-                # file not be missing. Ensure this is never the case.
-                existing_filenames.append(filename)
-            previous_dev_filenames = matching_dev_filenames(filename,
-                                                            existing_filenames)
-
-            # Only keep the last 5 dev builds
-            for filename in previous_dev_filenames[5:]:
-                print("Deleting old dev package %s" % filename)
-                try:
-                    obj = container.get_object(filename)
-                    driver.delete_object(obj)
-                except ObjectDoesNotExistError:
-                    pass
+            for attempt in range(self.max_verify_attempts):
+                with open(filepath, 'rb') as f:
+                    size = os.fstat(f.fileno()).st_size
+                    print("Uploading %s [%0.3f MB]" % (filepath, size / 1e6))
+                    reader = HashingReader(f, chunk_size=self.chunk_size)
+                    try:
+                        with tracker.transfer(filepath, size), \
+                                span('transfer', object=filename, size=size,
+                                     attempt=attempt):
+                            obj = driver.upload_object_via_stream(
+                                _UploadStream(tracker.track(filepath, reader),
+                                              reader),
+                                container=container, object_name=filename)
+                    except ObjectHashMismatchError as e:
+                        # Some drivers (e.g. CloudFiles) compare the digest
+                        # with the ETag themselves
+                        print("Checksum mismatch for %s: %s"
+                              % (filename, e.value))
+                        obj = None
+                if reader.size != size:
+                    raise IOError("Uploaded %d bytes out of %d for %s"
+                                  % (reader.size, size, filepath))
+                metadata = reader.metadata()
+
+                if obj is not None and self._verify_upload(obj, metadata):
+                    break
+                if attempt + 1 < self.max_verify_attempts:
+                    self._record_verification('reuploaded')
+            else:
+                raise IOError("Checksum mismatch for %s after %d upload "
+                              "attempts"
+                              % (filename, self.max_verify_attempts))
+
+            if self.delete_previous_dev_packages:
+                with span('delete_previous_dev_packages'):
+                    self._delete_previous_dev_packages(driver, container,
+                                                       filename)
+            return metadata
+
+    def _verify_upload(self, obj, metadata):
+        """Check the integrity of the stored object without downloading it
+
+        Return False in case of checksum mismatch.
+
+        """
+        remote_md5 = self._remote_md5(obj)
+        if remote_md5 is None or 'md5' not in metadata:
+            self._record_verification('unverified')
+            return True
+        if remote_md5 == metadata['md5']:
+            self._record_verification('verified')
+            return True
+        print("Checksum mismatch for %s: local md5 %s, remote %s"
+              % (obj.name, metadata['md5'], remote_md5))
+        return False
+
+    def _delete_previous_dev_packages(self, driver, container, filename):
+        # Only list the packages of the same project when the driver
+        # supports it
+        prefix = None
+        if filename.endswith('.whl'):
+            prefix = filename.split('-', 1)[0] + '-'
+        existing_filenames = _ensure_listed(
+            filename, self._iter_package_filenames(driver, container,
+                                                   prefix=prefix))
+        previous_dev_filenames = matching_dev_filenames(filename,
+                                                        existing_filenames)
+
+        # Only keep the last 5 dev builds
+        for filename in previous_dev_filenames[5:]:
+            print("Deleting old dev package %s" % filename)
+            try:
+                obj = container.get_object(filename)
+                driver.delete_object(obj)
+            except ObjectDoesNotExistError:
+                pass
 
     def get_container_cdn_url(self, container_name):
         driver = self.make_driver()
@@ -264,3 +1037,239 @@ class Uploader(object):
                                             index_file=self.index_filename)
         driver.enable_container_cdn(container)
         return driver.get_container_cdn_url(container)
+
+
+_END = object()
+
+_ABORT = object()
+
+
+class _QueueIterator(object):
+    """Iterate over the chunks put in a queue until the end marker"""
+
+    def __init__(self, queue):
+        self.queue = queue
+        self.exhausted = False
+
+    def __iter__(self):
+        while not self.exhausted:
+            chunk = self.queue.get()
+            if chunk is _END or chunk is _ABORT:
+                self.exhausted = True
+                if chunk is _ABORT:
+                    raise IOError("Reading the source file failed")
+                return
+            yield chunk
+
+    def drain(self):
+        # Unblock the producer if the consumer stopped early
+        while not self.exhausted:
+            chunk = self.queue.get()
+            self.exhausted = chunk is _END or chunk is _ABORT
+
+
+def _tee(chunks, consumers, max_pending=8):
+    """Feed the same chunks to several consumers running concurrently
+
+    Each consumer is called in its own thread with an iterator over the
+    chunks. At most max_pending chunks are buffered per consumer. Return the
+    list of (result, exception) pairs of the consumers.
+
+    >>> _tee(iter([b'a', b'b']), [b''.join, lambda chunks: len(list(chunks))])
+    [(b'ab', None), (2, None)]
+
+    A failing consumer does not affect the others, a failure to read the
+    chunks is raised once all the consumers have stopped:
+
+    >>> def failing_consumer(chunks):
+    ...     raise ValueError('upload failed')
+    >>> _tee(iter([b'a', b'b']), [failing_consumer, b''.join])
+    [(None, ValueError('upload failed')), (b'ab', None)]
+    >>> def failing_chunks():
+    ...     yield b'a'
+    ...     raise IOError('read failed')
+    >>> _tee(failing_chunks(), [b''.join])
+    Traceback (most recent call last):
+        ...
+    OSError: read failed
+
+    """
+    queues = [Queue(maxsize=max_pending) for _ in consumers]
+    results = [None] * len(consumers)
+
+    def run(i):
+        chunk_iterator = _QueueIterator(queues[i])
+        try:
+            results[i] = (consumers[i](iter(chunk_iterator)), None)
+        except Exception as e:
+            results[i] = (None, e)
+        finally:
+            chunk_iterator.drain()
+
+    threads = [threading.Thread(target=run, args=(i,))
+               for i in range(len(consumers))]
+    for thread in threads:
+        thread.daemon = True
+        thread.start()
+    end_marker = _ABORT
+    try:
+        for chunk in chunks:
+            for queue in queues:
+                queue.put(chunk)
+        end_marker = _END
+    finally:
+        for queue in queues:
+            queue.put(end_marker)
+        for thread in threads:
+            thread.join()
+    return results
+
+
+class FanOutUploader(object):
+    """Upload the content of a local folder to several destinations
+
+    Destinations are (uploader, container_name) pairs: they can use
+    different providers, regions or credentials. Each file is read and
+    hashed once while its content is streamed to all the destinations
+    concurrently. The metadata and index files of the destinations are then
+    updated in parallel.
+
+    The scanning options (recursion, include and exclude patterns) of the
+    first uploader are used.
+
+    """
+
+    def __init__(self, destinations, max_workers=4, progress=None):
+        self.destinations = list(destinations)
+        self.max_workers = max_workers
+        if progress is None:
+            progress = ProgressListener()
+        self.progress = progress
+        self._tracker = ProgressTracker(self.progress)
+
+    def _label(self, uploader, container_name):
+        return "%s:%s" % (uploader.provider_name, container_name)
+
+    def upload(self, local_folder, retry_on_error=3):
+        """Wrapper to make upload more robust to random server errors"""
+        try:
+            return self._try_upload_once(local_folder)
+        except InvalidCredsError:
+            raise
+        except Exception as e:
+            if retry_on_error <= 0:
+                raise
+            # can be caused by any network or server side failure
+            print(e)
+            print_exc()
+            sleep(1)
+            self.upload(local_folder, retry_on_error=retry_on_error - 1)
+
+    def _try_upload_once(self, local_folder):
+        n_destinations = len(self.destinations)
+        with ThreadPoolExecutor(max_workers=n_destinations) as e:
+            # check that the containers are reachable
+            targets = list(e.map(
+                lambda d: d[0]._get_or_create_container(d[1]),
+                self.destinations))
+
+        primary_uploader = self.destinations[0][0]
+        filepaths = primary_uploader._scan_local_files(local_folder)
+        print("About to upload %d files to %d destinations"
+              % (len(filepaths), n_destinations))
+
+        local_metadata = {}
+        self._tracker = _make_tracker(self.progress, filepaths)
+        try:
+            with span('upload_files', n_files=len(filepaths)), \
+                    ThreadPoolExecutor(max_workers=self.max_workers) as e:
+                futures = dict((e.submit(self.upload_file, filepath_),
+                                os.path.basename(filepath_))
+                               for filepath_ in filepaths)
+                for future in as_completed(futures):
+                    # Raise an exception early in case of problem
+                    local_metadata[futures[future]] = future.result()
+        finally:
+            self._tracker.close()
+
+        for uploader, container_name in self.destinations:
+            uploader._report_verification(
+                label=self._label(uploader, container_name))
+
+        recently_uploaded = [os.path.basename(path) for path in filepaths]
+        with ThreadPoolExecutor(max_workers=n_destinations) as e:
+            futures = [e.submit(uploader._refresh_container, driver,
+                                container, local_metadata,
+                                recently_uploaded=recently_uploaded,
+                                label=self._label(uploader, container_name))
+                       for (uploader, container_name), (driver, container)
+                       in zip(self.destinations, targets)]
+            for future in as_completed(futures):
+                future.result()
+
+    def upload_file(self, filepath):
+        """Upload a file to all the destinations and return its metadata"""
+        with span('upload_file', file=filepath,
+                  n_destinations=len(self.destinations)):
+            return self._upload_file(filepath)
+
+    def _upload_file(self, filepath):
+        filename = os.path.basename(filepath)
+        targets = []
+        for uploader, container_name in self.destinations:
+            # drivers are not thread safe, hence we create one per upload task
+            driver = uploader.make_driver()
+            with span('get_container', container=container_name):
+                container = driver.get_container(container_name)
+            targets.append((uploader, driver, container))
+
+        def make_consumer(uploader, driver, container, reader):
+            def consumer(chunks):
+                with span('transfer', object=filename,
+                          destination=self._label(uploader, container.name)):
+                    return driver.upload_object_via_stream(
+                        _UploadStream(chunks, reader), container=container,
+                        object_name=filename)
+            return consumer
+
+        with open(filepath, 'rb') as f:
+            size = os.fstat(f.fileno()).st_size
+            print("Uploading %s [%0.3f MB] to %d destinations"
+                  % (filepath, size / 1e6, len(targets)))
+            reader = HashingReader(f, chunk_size=targets[0][0].chunk_size)
+            # The progress is the pace at which the slowest destination
+            # consumes the content of the file
+            with self._tracker.transfer(filepath, size):
+                results = _tee(self._tracker.track(filepath, reader),
+                               [make_consumer(uploader, driver, container,
+                                              reader)
+                                for uploader, driver, container in targets])
+        if reader.size != size:
+            raise IOError("Read %d bytes out of %d for %s"
+                          % (reader.size, size, filepath))
+        metadata = reader.metadata()
+
+        for (uploader, driver, container), (obj, error) in zip(targets,
+                                                               results):
+            if error is None and uploader._verify_upload(obj, metadata):
+                if uploader.delete_previous_dev_packages:
+                    with span('delete_previous_dev_packages'):
+                        uploader._delete_previous_dev_packages(
+                            driver, container, filename)
+                continue
+            # Upload again to this destination only: the file is read again
+            # but the other destinations are not affected
+            label = self._label(uploader, container.name)
+            if isinstance(error, ObjectHashMismatchError):
+                print("Checksum mismatch for %s on %s: %s"
+                      % (filename, label, error.value))
+                uploader._record_verification('reuploaded')
+            elif error is not None:
+                print("Failed to upload %s to %s: %s %s"
+                      % (filepath, label, type(error).__name__, error))
+            else:
+                uploader._record_verification('reuploaded')
+            print("Uploading %s to %s again" % (filepath, label))
+            uploader.upload_file(filepath, container.name,
+                                 tracker=self._tracker)
+        return metadata
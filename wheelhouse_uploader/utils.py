@@ -1,8 +1,8 @@
 import sys
 import re
+from fnmatch import fnmatchcase
 from datetime import datetime
-from pkg_resources import safe_version, parse_version
-from packaging.version import VERSION_PATTERN
+from packaging.version import VERSION_PATTERN, Version, InvalidVersion
 
 # PEP440 version spec
 _version_regex = re.compile('^' + VERSION_PATTERN + '$',
@@ -11,6 +11,37 @@ _version_regex = re.compile('^' + VERSION_PATTERN + '$',
 _stamp_regex = re.compile(r'(\d{14})(_\w+)?')
 
 
+def parse_version(version):
+    """Parse a PEP 440 version string
+
+    Replacement for pkg_resources.parse_version that does not pay the cost of
+    importing pkg_resources (which scans all the installed distributions).
+
+    >>> parse_version('0.15.dev0+local3') < parse_version('0.15')
+    True
+
+    """
+    return Version(version)
+
+
+def safe_version(version):
+    """Normalize a version string, as pkg_resources.safe_version does
+
+    >>> safe_version('0.15.1rc')
+    '0.15.1rc0'
+    >>> safe_version('1.0 beta')
+    '1.0.beta'
+    >>> safe_version('not a version')
+    'not.a.version'
+
+    """
+    try:
+        return str(Version(version))
+    except InvalidVersion:
+        version = version.replace(' ', '.')
+        return re.sub('[^A-Za-z0-9.]+', '-', version)
+
+
 def _wheel_escape(component):
     return re.sub("[^\w\d.]+", "_", component, re.UNICODE)
 
@@ -176,6 +207,52 @@ def _parse_source_filename(basename, project_name=None, return_tags=True):
     return (distname, safe_version(version), '', 'sdist')
 
 
+def match_tags(tags, python=None, abi=None, platform=None):
+    """Check that the tags of an artifact match glob-style patterns
+
+    The tags are the dict returned by ``parse_filename(...,
+    return_tags=True)``. Each pattern can be a comma-separated list of
+    alternatives. Filters left to None match any artifact.
+
+    >>> tags = parse_filename('project-0.1-cp311-cp311-manylinux_2_17_x86_64'
+    ...                       '.manylinux2014_x86_64.whl',
+    ...                       return_tags=True)[-1]
+    >>> match_tags(tags, python='cp311', platform='manylinux*')
+    True
+    >>> match_tags(tags, python='cp3*', abi='abi3')
+    False
+
+    Compressed tag sets match if any of their components matches:
+
+    >>> match_tags(tags, platform='manylinux2014_x86_64')
+    True
+    >>> tags = parse_filename('project-0.1-py2.py3-none-any.whl',
+    ...                       return_tags=True)[-1]
+    >>> match_tags(tags, python='py3', platform='win*,any')
+    True
+
+    Artifacts without the filtered tag, such as sdists, do not match:
+
+    >>> match_tags({}, python='cp311')
+    False
+    >>> match_tags({})
+    True
+
+    """
+    for key, patterns in [('python', python), ('abi', abi),
+                          ('platform', platform)]:
+        if patterns is None:
+            continue
+        if key not in tags:
+            return False
+        values = [tags[key]] + tags[key].split('.')
+        patterns = [p.strip() for p in patterns.split(',') if p.strip()]
+        if not any(fnmatchcase(value, pattern)
+                   for value in values for pattern in patterns):
+            return False
+    return True
+
+
 def is_dev(version):
     """Look for dev flag in PEP440 version number
 